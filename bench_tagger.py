@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from argparse import ArgumentParser
+from functools import reduce
+from random import choice, randint, sample, seed
+from string import ascii_lowercase
+from timeit import timeit
+
+from yandere_dl import *
+
+
+def _legacy_cut_tags(tags):
+    if len(' '.join(tags)) <= MAX_TAGS_LEN: return tags
+    return _legacy_cut_tags(tags[:-1])
+
+
+def _legacy_filter_tags(categories, tags):
+    origin = set(tags.split(' '))
+    filtered = reduce(lambda x, y: x + y, [list(sorted(filter(
+        lambda c: tags.find('(%s)' % c) == -1, origin.intersection(tags_)
+    ))) for tags_ in categories])
+    if len(filtered) == 0: filtered = tags.split(' ')
+    return ' '.join(_legacy_cut_tags(filtered))
+
+
+def _make_tag():
+    tag = ''.join(choice(ascii_lowercase) for _ in range(randint(3, 12)))
+    return tag + '_(%s)' % ''.join(choice(ascii_lowercase) for _ in range(5)) if randint(0, 9) == 0 else tag
+
+
+def args_parse():
+    parser = ArgumentParser(description='Tagger.filter_tags microbenchmark')
+    parser.add_argument('--category_size', type=int, default=50000)
+    parser.add_argument('--post_tags', type=int, default=30)
+    parser.add_argument('--posts', type=int, default=2000)
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def main():
+    args = args_parse()
+    seed(0)
+    # every yande.re tag has exactly one type, so the categories don't overlap
+    known = list(set(_make_tag() for _ in range(args.category_size * len(Tagger.TAGS))))
+    categories = [set(known[i::len(Tagger.TAGS)]) for i in range(len(Tagger.TAGS))]
+    posts = [' '.join(sample(known, args.post_tags // 2) + [_make_tag() for _ in range(args.post_tags // 2)])
+             for _ in range(args.posts)]
+
+    tagger = Tagger.__new__(Tagger)
+    tagger.index = TagIndex(categories)
+    assert [_legacy_filter_tags(categories, p) for p in posts] == tagger.filter_tags_many(posts)
+
+    legacy = timeit(lambda: [_legacy_filter_tags(categories, p) for p in posts], number=1)
+    indexed = timeit(lambda: [tagger.filter_tags(p) for p in posts], number=1)
+    print('legacy : %8.2f us per call' % (legacy * 1e6 / len(posts)))
+    print('indexed: %8.2f us per call' % (indexed * 1e6 / len(posts)))
+
+
+if __name__ == '__main__':
+    main()
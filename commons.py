@@ -1,27 +1,66 @@
 # -*- coding: utf-8 -*-
-from json import load, dump
-from os import remove, rename, mkdir
-from os.path import join, exists, isfile, isdir, dirname, abspath
-from random import getrandbits
+from argparse import ArgumentParser
+from email.utils import parsedate_to_datetime
+from asyncio import Semaphore as AsyncSemaphore, get_running_loop, sleep as async_sleep
+from hashlib import md5
+from json import load, dump, loads, dumps, JSONDecoder
+from os import remove, rename, replace, mkdir, link, listdir
+from os.path import join, exists, isfile, isdir, dirname, abspath, splitext, getsize, basename, normcase, normpath
+from sqlite3 import connect
+from random import getrandbits, uniform
+from re import compile as compile_re, escape
 from math import pow
+from threading import Lock, BoundedSemaphore
+from time import monotonic, sleep, time
+from urllib.parse import urlparse, urlencode
+from zlib import compress as deflate, decompress as inflate
+
+from bs4 import BeautifulSoup, SoupStrainer
+from requests import Session, RequestException
+from requests.adapters import HTTPAdapter
+
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
 
 PROXIES={'http':'127.0.0.1:58304', 'https':'127.0.0.1:58304'}
+POOL_HOSTS = 4
+POOL_SIZE = 8
+HOST_LIMIT = 4
+ASYNC_LIMIT = 100
+
+DEFAULT_RATE = 5.0
+RETRIES = 3
+RETRY_METHODS = ('GET', 'HEAD')
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 120.0
+CACHE_SIZE = 256 * 1024 * 1024
+FULL_SWEEP = 7 * 24 * 3600
 
 BASE_DIR = dirname(abspath(__file__))
 WORK_DIR = 'D:\\_downloads_'
 
 MAX_TAGS_LEN = 130
+CHUNK_SIZE = 1024 * 1024
+PART_EXT = '.part'
+
+
+NORMALIZE_TABLE = str.maketrans({'*': '＊', ':': '：', '?': '？', '/': '／', '|': '-', '\\': '_',
+                                 '"': '\'', '<': '\'', '>': '\''})
 
 
 def normalize(name):
-    return name.replace('*', '＊').replace(':', '：').replace('?', '？'). \
-        replace('/', '／').replace('|', '-').replace('\\', '_'). \
-        replace('"', '\'').replace('<', '\'').replace('>', '\'')
+    return name.translate(NORMALIZE_TABLE)
 
 
 def cut_tags(tags):
-    if len(' '.join(tags)) <= MAX_TAGS_LEN: return tags
-    return cut_tags(tags[:-1])
+    size = -1
+    for i, tag in enumerate(tags):
+        size += len(tag) + 1
+        if size > MAX_TAGS_LEN: return tags[:i]
+    return tags
 
 
 def make_tag_dir(work_dir, tag):
@@ -30,11 +69,382 @@ def make_tag_dir(work_dir, tag):
     return tag_dir
 
 
-def dl_file(resp, work_dir, file, file_id):
-    with open(join(work_dir, normalize(file)), 'wb') as fd:
-        for chunk in resp.iter_content(50 * 1024 * 1024): fd.write(chunk)
-    print('File[%10d] Downloaded file: %s' % (file_id, file))
-    return True
+def html_only(names, classes):
+    # class tokens are matched on the raw attribute, a plain class_ list misses multi-class nodes
+    return SoupStrainer(names, class_=compile_re(r'(?:^|\s)(?:%s)(?:\s|$)' % '|'.join(map(escape, classes))))
+
+
+def parse_html(text, only=None):
+    # only: SoupStrainer restricting the tree to the nodes a scraper actually reads
+    return BeautifulSoup(text, features=HTML_PARSER, parse_only=only)
+
+
+def iter_json_array(chunks):
+    # yields the items of a top level JSON array while the text is still arriving
+    decoder, buf, pos = JSONDecoder(), '', 0
+    for chunk in chunks:
+        buf, pos = buf[pos:] + chunk, 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,[': pos += 1
+            if pos == len(buf): break
+            if buf[pos] == ']': return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break  # the item is cut by the chunk border, wait for the rest
+            # a number (or literal) running up to the border may go on in the next chunk
+            if end == len(buf) and not isinstance(item, (dict, list, str)): break
+            pos = end
+            yield item
+
+
+def _expected_size(resp, offset):
+    # Content-Length of an encoded body doesn't match the decoded bytes iter_content yields
+    if resp.headers.get('Content-Encoding', 'identity') != 'identity': return None
+    length = resp.headers.get('Content-Length')
+    return offset + int(length) if length else None
+
+
+class NameAllocator:
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.taken = set(map(normcase, listdir(work_dir))) if isdir(work_dir) else set()
+        self.last, self.counters = {}, {}
+        self.lock = Lock()
+
+    def _numbered(self, file):
+        stem, ext = splitext(file)
+        self.counters[file] = self.counters.get(file, 0) + 1
+        return '%s (%d)%s' % (stem, self.counters[file], ext)
+
+    def allocate(self, file, next_name=None):
+        # next_name(name) gives the candidate after name, by default "name (n).ext"
+        with self.lock:
+            name = self.last.get(file, file)
+            # the listing is read once, files other processes created since are looked up on disk
+            while normcase(name) in self.taken or exists(join(self.work_dir, name)):
+                name = next_name(name) if next_name else self._numbered(file)
+            self.last[file] = name
+            self.taken.add(normcase(name))
+            return name
+
+    def release(self, file):
+        with self.lock: self.taken.discard(normcase(file))
+
+
+_allocators = {}
+_allocators_lock = Lock()
+
+
+def get_allocator(work_dir):
+    key = normcase(normpath(abspath(work_dir)))
+    with _allocators_lock:
+        if key not in _allocators: _allocators[key] = NameAllocator(work_dir)
+    return _allocators[key]
+
+
+def allocate_path(file_path, next_name=None):
+    return join(dirname(file_path), get_allocator(dirname(file_path)).allocate(basename(file_path), next_name))
+
+
+def release_path(file_path):
+    get_allocator(dirname(file_path)).release(basename(file_path))
+
+
+_file_index = None
+
+
+def use_file_index(index):
+    global _file_index
+    _file_index = index
+    return index
+
+
+def hash_file(file_path):
+    digest = md5()
+    with open(file_path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''): digest.update(chunk)
+    return digest
+
+
+def finish_file(part_path, file_path, digest):
+    file_path = allocate_path(file_path)
+    if _file_index: _file_index.place(part_path, file_path, digest)
+    else: replace(part_path, file_path)
+    return file_path
+
+
+def store_file(src, file_path):
+    part_path = file_path + PART_EXT
+    digest = md5()
+    with open(part_path, 'wb') as fd:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            fd.write(chunk)
+            digest.update(chunk)
+    return finish_file(part_path, file_path, digest.hexdigest())
+
+
+def _finish_download(part_path, file_path, digest, size, file_id, file):
+    if size is not None and getsize(part_path) != size:
+        print('File[%10d] Incomplete file: %s (%d of %d bytes)' % (file_id, file, getsize(part_path), size))
+        return False
+    file_path = finish_file(part_path, file_path, digest.hexdigest())
+    print('File[%10d] Downloaded file: %s' % (file_id, basename(file_path)))
+    return file_path
+
+
+def dl_file(resp, work_dir, file, file_id, offset=0):
+    file_path = join(work_dir, normalize(file))
+    part_path = file_path + PART_EXT
+    size = _expected_size(resp, offset)
+    digest = hash_file(part_path) if offset else md5()
+    with open(part_path, 'ab' if offset else 'wb') as fd:
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            fd.write(chunk)
+            digest.update(chunk)
+    return _finish_download(part_path, file_path, digest, size, file_id, file)
+
+
+def _prepare_download(work_dir, file, file_id, digest, headers):
+    # returns the resume offset and the path of a known copy linked in place of a download
+    if digest and _file_index:
+        file_path = allocate_path(join(work_dir, normalize(file)))
+        if _file_index.reuse(digest, file_path):
+            print('File[%10d] Linked known file: %s' % (file_id, basename(file_path)))
+            return 0, file_path
+        release_path(file_path)
+    part_path = join(work_dir, normalize(file)) + PART_EXT
+    offset = getsize(part_path) if isfile(part_path) else 0
+    if offset: headers['Range'] = 'bytes=%d-' % offset
+    return offset, None
+
+
+def _resume_mode(status, content_range, offset):
+    if status == 416 and content_range == 'bytes */%d' % offset: return 'complete'
+    if status == 206 and content_range.startswith('bytes %d-' % offset): return 'resume'
+    if offset and status in (206, 416): return 'restart'
+    if status == 200: return 'full'
+
+
+def _complete_part(work_dir, file, file_id):
+    part_path = join(work_dir, normalize(file)) + PART_EXT
+    file_path = finish_file(part_path, join(work_dir, normalize(file)), hash_file(part_path).hexdigest())
+    print('File[%10d] Downloaded file: %s' % (file_id, basename(file_path)))
+    return file_path
+
+
+# resumes a leftover .part file, returns the path the file got, False when it came incomplete
+# and None when the server has no such file
+def dl_url(session, url, work_dir, file, file_id, digest=None, **kwargs):
+    headers = dict(kwargs.pop('headers', None) or {})
+    offset, linked = _prepare_download(work_dir, file, file_id, digest, headers)
+    if linked: return linked
+    # the reply goes back to the connection pool whichever way it is handled
+    with session.get(url, headers=headers, stream=True, **kwargs) as resp:
+        mode = _resume_mode(resp.status_code, resp.headers.get('Content-Range', ''), offset)
+        if mode == 'complete': return _complete_part(work_dir, file, file_id)
+        if mode == 'resume':
+            print('File[%10d] Resuming file from %d bytes: %s' % (file_id, offset, file))
+            return dl_file(resp, work_dir, file, file_id, offset)
+        if mode == 'full':
+            return dl_file(resp, work_dir, file, file_id)
+    if mode == 'restart':
+        remove(join(work_dir, normalize(file)) + PART_EXT)
+        headers.pop('Range')
+        return dl_url(session, url, work_dir, file, file_id, headers=headers, **kwargs)
+
+
+class AsyncSession:
+    def __init__(self, cookies=None, headers=None, proxies=PROXIES, per_host=HOST_LIMIT, limit=ASYNC_LIMIT,
+                 rate=DEFAULT_RATE):
+        self.cookies, self.headers, self.proxies = cookies, headers, proxies
+        self.per_host, self.limit = per_host, limit
+        self.slots = {}
+        self.limiters = HostLimiters(rate)
+        self.session, self.errors = None, ()
+
+    async def __aenter__(self):
+        # aiohttp is only needed by the async download paths
+        from aiohttp import ClientSession, ClientError, TCPConnector
+        self.session = ClientSession(connector=TCPConnector(limit=self.limit, limit_per_host=self.per_host),
+                                     cookies=self.cookies, headers=self.headers)
+        self.errors = ClientError
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def _proxy(self, url):
+        proxy = self.proxies.get(urlparse(url).scheme)
+        return proxy if not proxy or '://' in proxy else 'http://' + proxy
+
+    def _slot(self, url):
+        host = urlparse(url).netloc
+        if host not in self.slots: self.slots[host] = AsyncSemaphore(self.per_host)
+        return self.slots[host]
+
+    async def _get(self, url, **kwargs):
+        # same retry policy as SiteSession.request for GET
+        limiter = self.limiters.get(url)
+        for i in range(RETRIES):
+            await limiter.acquire_async()
+            try:
+                resp = await self.session.get(url, proxy=self._proxy(url), **kwargs)
+            except self.errors:
+                limiter.feedback()
+                if i == RETRIES - 1: raise
+                continue
+            limiter.feedback(resp.status, _retry_after(resp.headers))
+            if resp.status != 429 and resp.status < 500 or i == RETRIES - 1: return resp
+            resp.release()
+
+    # same contract as dl_url
+    async def dl_url(self, url, work_dir, file, file_id, digest=None, **kwargs):
+        headers = dict(kwargs.pop('headers', None) or {})
+        offset, linked = _prepare_download(work_dir, file, file_id, digest, headers)
+        if linked: return linked
+        async with self._slot(url):
+            async with await self._get(url, headers=headers, **kwargs) as resp:
+                mode = _resume_mode(resp.status, resp.headers.get('Content-Range', ''), offset)
+                if mode == 'complete':
+                    return await get_running_loop().run_in_executor(None, _complete_part, work_dir, file, file_id)
+                if mode in ('resume', 'full'):
+                    if mode == 'resume': print('File[%10d] Resuming file from %d bytes: %s' % (file_id, offset, file))
+                    return await self._dl_file(resp, work_dir, file, file_id, offset if mode == 'resume' else 0)
+        if mode == 'restart':
+            remove(join(work_dir, normalize(file)) + PART_EXT)
+            headers.pop('Range')
+            return await self.dl_url(url, work_dir, file, file_id, headers=headers, **kwargs)
+
+    @staticmethod
+    async def _dl_file(resp, work_dir, file, file_id, offset=0):
+        # disk writes and hashing run on the default executor, the loop only waits for the network
+        loop = get_running_loop()
+        file_path = join(work_dir, normalize(file))
+        part_path = file_path + PART_EXT
+        size = _expected_size(resp, offset)
+        digest = await loop.run_in_executor(None, hash_file, part_path) if offset else md5()
+
+        def write(chunk):
+            fd.write(chunk)
+            digest.update(chunk)
+
+        with open(part_path, 'ab' if offset else 'wb') as fd:
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE): await loop.run_in_executor(None, write, chunk)
+        return await loop.run_in_executor(None, _finish_download, part_path, file_path, digest, size, file_id, file)
+
+
+def _retry_after(headers):
+    value = headers.get('Retry-After')
+    if not value: return None
+    if value.isdigit(): return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    # token bucket that halves its rate on 429/5xx/errors and ramps back by a tenth per healthy response
+    def __init__(self, rate=DEFAULT_RATE, burst=1):
+        self.max_rate, self.rate, self.min_rate = rate, rate, rate / 16
+        self.burst, self.tokens = burst, burst
+        self.stamp, self.paused_until, self.failures = monotonic(), 0, 0
+        self.lock = Lock()
+
+    def _reserve(self):
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - 1
+            self.stamp = now
+            return max(-self.tokens / self.rate, self.paused_until - now)
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0: sleep(delay)
+
+    async def acquire_async(self):
+        delay = self._reserve()
+        if delay > 0: await async_sleep(delay)
+
+    def feedback(self, status=None, retry_after=None):
+        with self.lock:
+            if status is None or status == 429 or status >= 500:
+                self.failures += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                if retry_after is None:
+                    retry_after = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.failures - 1)) * uniform(0.5, 1.5)
+                self.paused_until = max(self.paused_until, monotonic() + retry_after)
+            elif status < 400:
+                self.failures = 0
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class HostLimiters:
+    def __init__(self, rate=DEFAULT_RATE):
+        self.rate = rate
+        self.limiters = {}
+        self.lock = Lock()
+
+    def get(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.limiters: self.limiters[host] = RateLimiter(self.rate)
+        return self.limiters[host]
+
+
+class SiteSession(Session):
+    def __init__(self, rate=DEFAULT_RATE):
+        super().__init__()
+        self.limiters = HostLimiters(rate)
+
+    def request(self, method, url, **kwargs):
+        # explicit proxies win over environment ones, same as the bare requests.request calls did
+        kwargs.setdefault('proxies', self.proxies)
+        limiter = self.limiters.get(url)
+        # only reads are repeated, a form post like a login may already have been handled
+        retries = RETRIES if method.upper() in RETRY_METHODS else 1
+        for i in range(retries):
+            limiter.acquire()
+            try:
+                resp = super().request(method, url, **kwargs)
+            except RequestException:
+                limiter.feedback()
+                if i == retries - 1: raise
+                continue
+            limiter.feedback(resp.status_code, _retry_after(resp.headers))
+            if resp.status_code != 429 and resp.status_code < 500 or i == retries - 1: break
+            # the unread reply hands its connection back to the pool before the next try
+            resp.close()
+        return resp
+
+
+_sessions = {}
+
+
+def get_session(site, cookies=None, headers=None, proxies=PROXIES, rate=DEFAULT_RATE):
+    session = _sessions.get(site)
+    if session is None:
+        session = SiteSession(rate)
+        adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.proxies = dict(proxies)
+        _sessions[site] = session
+    if cookies: session.cookies.update(cookies)
+    if headers: session.headers.update(headers)
+    return session
+
+
+_host_slots = {}
+_host_lock = Lock()
+
+
+def host_slot(url, limit=HOST_LIMIT):
+    host = urlparse(url).netloc
+    with _host_lock:
+        if host not in _host_slots: _host_slots[host] = BoundedSemaphore(limit)
+    return _host_slots[host]
 
 
 class JsonData:
@@ -58,6 +468,7 @@ class JsonData:
 
 class History(JsonData):
     def __init__(self, work_dir=BASE_DIR, file_name='history.json'):
+        self.id_sets = {}
         super().__init__(work_dir, file_name)
 
     def get_category(self, category):
@@ -65,6 +476,7 @@ class History(JsonData):
         return self.data[category]
 
     def set_category(self, category, data):
+        self.id_sets = {key: ids for key, ids in self.id_sets.items() if key[0] != category}
         self.data[category] = data
 
     def get_item(self, category, item, default=None):
@@ -73,8 +485,312 @@ class History(JsonData):
         return category_[item]
 
     def set_item(self, category, item, data):
+        self.id_sets.pop((category, item), None)
         self.get_category(category)[item] = data
 
+    def _get_ids(self, category, item):
+        key = (category, item)
+        if key not in self.id_sets: self.id_sets[key] = set(self.get_item(category, item, []))
+        return self.id_sets[key]
+
+    def contains(self, category, item, value):
+        return value in self._get_ids(category, item)
+
+    def add(self, category, item, value):
+        ids = self._get_ids(category, item)
+        if value in ids: return
+        ids.add(value)
+        self.get_item(category, item).append(value)
+
+    def ids(self, category, item):
+        return list(self.get_item(category, item, []))
+
+    def sort_ids(self, category, item, reverse=False):
+        self.get_item(category, item, []).sort(reverse=reverse)
+
+
+class SqliteHistory(History):
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS items (category TEXT, item TEXT, data TEXT, PRIMARY KEY (category, item));
+        CREATE TABLE IF NOT EXISTS ids (category TEXT, item TEXT, value, PRIMARY KEY (category, item, value))
+            WITHOUT ROWID;
+    '''
+    ID_CATEGORIES = ('posts', 'downloads')
+
+    def __init__(self, work_dir=BASE_DIR, file_name='history.db'):
+        self.db = connect(join(work_dir, file_name), check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+        self.lock = Lock()
+        self.written = {}
+        self.dirty = {}
+        super().__init__(work_dir, file_name)
+
+    def load(self):
+        # categories are read lazily, the database is the source of truth
+        self.data = {}
+
+    def _load_category(self, category):
+        if category not in self.data.keys():
+            with self.lock:
+                rows = self.db.execute('SELECT item, data FROM items WHERE category = ?', (category,)).fetchall()
+            self.data[category] = {item: loads(data) for item, data in rows}
+            self.written[category] = dict(rows)
+        return self.data[category]
+
+    def _mark(self, category, item=None):
+        # None stands for the whole category, handed out items may be changed in place by the caller
+        if item is None: self.dirty[category] = None
+        elif self.dirty.setdefault(category, set()) is not None: self.dirty[category].add(item)
+
+    def get_category(self, category):
+        self._mark(category)
+        return self._load_category(category)
+
+    def set_category(self, category, data):
+        self._load_category(category)
+        self._mark(category)
+        self.data[category] = data
+
+    def get_item(self, category, item, default=None):
+        category_ = self._load_category(category)
+        if item not in category_.keys(): category_[item] = default
+        self._mark(category, item)
+        return category_[item]
+
+    def set_item(self, category, item, data):
+        self._load_category(category)[item] = data
+        self._mark(category, item)
+
+    def contains(self, category, item, value):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM ids WHERE category = ? AND item = ? AND value = ?',
+                                   (category, item, value)).fetchone() is not None
+
+    def add(self, category, item, value):
+        # committed together with the next save()
+        with self.lock: self.db.execute('INSERT OR IGNORE INTO ids VALUES (?, ?, ?)', (category, item, value))
+
+    def ids(self, category, item):
+        with self.lock:
+            rows = self.db.execute('SELECT value FROM ids WHERE category = ? AND item = ?', (category, item))
+            return [row[0] for row in rows]
+
+    def sort_ids(self, category, item, reverse=False):
+        # the ids table keeps no order, ids() hands them out in key order
+        pass
+
+    def save(self, indent=None):
+        # only items handed out since loading can differ from what was written
+        with self.lock, self.db:
+            for category, keys in self.dirty.items():
+                items, written = self.data[category], self.written[category]
+                if keys is None:
+                    for item in set(written.keys()).difference(map(str, items.keys())):
+                        self.db.execute('DELETE FROM items WHERE category = ? AND item = ?', (category, item))
+                        del written[item]
+                    keys = items.keys()
+                for item in keys:
+                    if item not in items: continue
+                    data = dumps(items[item])
+                    if written.get(str(item)) == data: continue
+                    self.db.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?)', (category, str(item), data))
+                    written[str(item)] = data
+            # plain values can only change through set_item, which marks them again
+            self.dirty = {category: keys if keys is None else {
+                item for item in keys if isinstance(self.data[category].get(item), (dict, list))}
+                for category, keys in self.dirty.items()}
+
+    def import_json(self, file_path):
+        with open(file_path, 'r') as f: data = load(f)
+        with self.lock, self.db:
+            for category, items in data.items():
+                for item, value in items.items():
+                    if category in self.ID_CATEGORIES and isinstance(value, list):
+                        self.db.executemany('INSERT OR IGNORE INTO ids VALUES (?, ?, ?)',
+                                            [(category, item, v) for v in value])
+                    else:
+                        self.db.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+                                        (category, item, dumps(value)))
+        self.data, self.written, self.dirty = {}, {}, {}
+        print('History imported from %s' % file_path)
+
+
+_histories = {}
+
+
+def make_history(work_dir=BASE_DIR, file_name='history.json'):
+    # one loaded history per file for the whole process, so every downloader sees the same state
+    key = normcase(normpath(join(work_dir, file_name)))
+    if key not in _histories:
+        db_name = splitext(file_name)[0] + '.db'
+        if isfile(join(work_dir, db_name)): _histories[key] = SqliteHistory(work_dir, db_name)
+        else: _histories[key] = History(work_dir, file_name)
+    return _histories[key]
+
+
+class Watermark:
+    # highest post id of a tag/artist below which everything is handled, crawls stop at the first page under it
+    def __init__(self, history, item, full_sweep=False):
+        self.history, self.item = history, item
+        self.mark = history.get_item('watermarks', item, {'id': 0, 'swept': 0})
+        self.full = full_sweep or time() - self.mark['swept'] >= FULL_SWEEP
+        self.top = self.mark['id']
+        # posts that failed on earlier runs, callers fetch them again by id
+        self.retry = set(self.mark.get('retry', []))
+        self.failed = []
+
+    def below(self, post_id):
+        return not self.full and int(post_id) <= self.mark['id'] and int(post_id) not in self.retry
+
+    def reached(self, post_ids):
+        # newest first listings: a page with nothing above the mark means the rest is known
+        post_ids = [int(post_id) for post_id in post_ids]
+        if post_ids: self.top = max(self.top, max(post_ids))
+        return not self.full and all(post_id <= self.mark['id'] for post_id in post_ids)
+
+    def fail(self, post_id):
+        self.failed.append(int(post_id))
+
+    def commit(self, complete=True):
+        # failed posts wait in the retry list, the mark moves up to the newest post seen,
+        # a crawl cut short by a failed page keeps the old mark so the pages above it are walked again
+        if complete: self.mark['id'] = self.top
+        self.mark['retry'] = sorted(set(self.failed))
+        if self.full and complete: self.mark['swept'] = time()
+        self.history.set_item('watermarks', self.item, self.mark)
+        print('Mark[%10d] Watermark for [%s]%s, %d to retry' % (
+            self.mark['id'], self.item, ' after full sweep' if self.full and complete else
+            '' if complete else ' kept, crawl cut short', len(self.mark['retry'])))
+
+
+class FileIndex:
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS files (digest TEXT PRIMARY KEY, path TEXT, size INTEGER)'
+
+    def __init__(self, work_dir=BASE_DIR, file_name='files.db', hardlink=True):
+        self.db = connect(join(work_dir, file_name), check_same_thread=False)
+        self.db.execute(self.SCHEMA)
+        self.lock = Lock()
+        self.hardlink = hardlink
+        self.duplicates, self.saved = 0, 0
+
+    def find(self, digest):
+        with self.lock: row = self.db.execute('SELECT path FROM files WHERE digest = ?', (digest,)).fetchone()
+        return row[0] if row and isfile(row[0]) else None
+
+    def add(self, digest, file_path):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                            (digest, abspath(file_path), getsize(file_path)))
+
+    def reuse(self, digest, file_path):
+        # hardlinks file_path to a stored copy, or just skips it when hardlink is off
+        existing = self.find(digest)
+        if existing is None or existing == abspath(file_path): return False
+        if self.hardlink:
+            try:
+                if exists(file_path): remove(file_path)
+                link(existing, file_path)
+            except OSError:
+                return False
+        with self.lock:
+            self.duplicates += 1
+            self.saved += getsize(existing)
+        return True
+
+    def place(self, part_path, file_path, digest):
+        if self.reuse(digest, file_path):
+            remove(part_path)
+        else:
+            replace(part_path, file_path)
+            self.add(digest, file_path)
+
+    def report(self):
+        print('Dedup: %d duplicate file(s), %s saved' % (self.duplicates, Sizer().format_size(self.saved)))
+
+
+class ResponseCache:
+    # conditional GETs keyed by url+params, bodies are kept deflated next to the parsed result
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, etag TEXT, modified TEXT, ' \
+             'body BLOB, result TEXT, size INTEGER, used REAL)'
+
+    def __init__(self, work_dir=BASE_DIR, file_name='responses.db', max_size=CACHE_SIZE):
+        self.db = connect(join(work_dir, file_name), check_same_thread=False)
+        self.db.execute(self.SCHEMA)
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.lock = Lock()
+        self.max_size = max_size
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def make_key(url, params=None):
+        return url + ('?' + urlencode(sorted(params.items())) if params else '')
+
+    def _lookup(self, key):
+        with self.lock:
+            return self.db.execute('SELECT etag, modified, body, result FROM responses WHERE key = ?',
+                                   (key,)).fetchone()
+
+    def _store(self, key, resp, text, result):
+        body = deflate(text.encode('utf-8') if isinstance(text, str) else text)
+        try:
+            result = dumps(result, ensure_ascii=False)
+        except TypeError:
+            result = None  # not JSON friendly, the body gets parsed again on revalidation
+        size = len(body) + len(result or '')
+        with self.lock, self.db:
+            row = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.size += size - (row[0] if row else 0)
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (key, resp.headers.get('ETag'), resp.headers.get('Last-Modified'),
+                             body, result, size, time()))
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size:
+            rows = self.db.execute('SELECT key, size FROM responses ORDER BY used LIMIT 100').fetchall()
+            if not rows: break
+            self.db.executemany('DELETE FROM responses WHERE key = ?', [(key,) for key, _ in rows])
+            self.size -= sum(size for _, size in rows)
+
+    def fetch(self, key, request, parse, decode=lambda resp: resp.text):
+        # request(headers) returns a response or None, parse(text) the value to cache for the page
+        row = self._lookup(key)
+        headers = {}
+        if row and row[0]: headers['If-None-Match'] = row[0]
+        if row and row[1]: headers['If-Modified-Since'] = row[1]
+        resp = request(headers)
+        if resp is None: return None
+        if resp.status_code == 304 and row:
+            with self.lock, self.db:
+                self.db.execute('UPDATE responses SET used = ? WHERE key = ?', (time(), key))
+                self.hits += 1
+            # a stored body comes back as bytes, parse_html takes either
+            return loads(row[3]) if row[3] is not None else parse(inflate(row[2]))
+        if resp.status_code != 200: return None
+        text = decode(resp)
+        result = parse(text)
+        with self.lock: self.misses += 1
+        if resp.headers.get('ETag') or resp.headers.get('Last-Modified'): self._store(key, resp, text, result)
+        return result
+
+    def get(self, session, url, parse, params=None, **kwargs):
+        return self.fetch(self.make_key(url, params),
+                          lambda headers: session.get(url, params=params, headers=headers, **kwargs), parse)
+
+    def report(self):
+        print('Cache: %d page(s) not modified, %d fetched, %s stored' % (
+            self.hits, self.misses, Sizer().format_size(self.size)))
+
+
+_response_caches = {}
+
+
+def get_response_cache(work_dir=BASE_DIR, file_name='responses.db'):
+    path = join(work_dir, file_name)
+    if path not in _response_caches: _response_caches[path] = ResponseCache(work_dir, file_name)
+    return _response_caches[path]
+
 
 class Cookie(JsonData):
     def __init__(self, work_dir=join(BASE_DIR, 'cookies'), file_name='cookie.json'):
@@ -115,3 +831,24 @@ class Sizer:
         if size < self.TB['v']: return '%.2f %s' % (size / self.GB['v'], self.GB['s'])
         if size < self.PB['v']: return '%.2f %s' % (size / self.TB['v'], self.TB['s'])
         return '%2f %s' % (size / self.PB['v'], self.PB['s'])
+
+
+def _args_parse():
+    parser = ArgumentParser(description='download helpers commons')
+    parser.add_argument('--work_dir', type=str, default=BASE_DIR)
+    parser.add_argument('--import_history', type=str, help='JSON history file to move into SQLite')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def _main():
+    args = _args_parse()
+
+    if args.import_history:
+        history = SqliteHistory(args.work_dir, splitext(args.import_history)[0] + '.db')
+        history.import_json(join(args.work_dir, args.import_history))
+
+
+if __name__ == '__main__':
+    _main()
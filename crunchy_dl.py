@@ -1,43 +1,85 @@
 # -*- coding: utf-8 -*-
 from argparse import ArgumentParser
-from subprocess import getstatusoutput, check_output
+from concurrent.futures import ThreadPoolExecutor
+from re import compile as compile_re, IGNORECASE
+from subprocess import getstatusoutput, Popen, PIPE, STDOUT
 
 from commons import *
 
 
 class CrunchyDL:
+    AUTH_TTL = 12 * 3600
+    # a bare 401 can be an episode id or a size, it only counts next to a status word
+    AUTH_ERROR = compile_re(r'\bunauthori[sz]ed\b|\b(?:http|status|code|error)\W{0,3}401\b', IGNORECASE)
+    DONE_MARKER = 'Subtitle downloaded'
 
-    def __init__(self, work_dir=WORK_DIR, history=None):
+    def __init__(self, work_dir=WORK_DIR, history=None, workers=3):
         self.work_dir = work_dir
         self.exec = join(work_dir, 'crunchy-beta.exe')
-        self.history = history if history else History(work_dir=work_dir, file_name='crunchy_dl.json')
+        self.history = history if history else make_history(work_dir, 'crunchy_dl.json')
+        self.workers = workers
+        self.lock = Lock()
+        self.auth_lock = Lock()
 
-    def _autorize(self):
-        auth = self.history.get_category('auth')
-        _, res = getstatusoutput(f'{self.exec} --auth --user {auth["user"]} --pass {auth["pass"]}')
-        print(f'Auth result: {_} - {res}')
+    def _autorize(self, force=False, seen=None):
+        # the tool keeps its token on disk, so a recent successful --auth is reused
+        with self.auth_lock:
+            auth = self.history.get_category('auth')
+            # another title already renewed the token that was rejected as seen
+            if force and seen is not None and auth.get('authed_at', 0) != seen: return True
+            if not force and time() - auth.get('authed_at', 0) < self.AUTH_TTL:
+                print(f'Auth reused from {int((time() - auth["authed_at"]) / 60)} min. ago')
+                return True
+            _, res = getstatusoutput(f'{self.exec} --auth --user {auth["user"]} --pass {auth["pass"]}')
+            print(f'Auth result: {_} - {res}')
+            with self.lock:
+                auth['authed_at'] = time() if _ == 0 else 0
+                self.history.save(2)
+            return _ == 0
 
-    def _dl_episode(self, item):
-        print(f'{"=" * 40}')
-        print(f'Downloading {item["ep"]} ep. of "{item["title"]}"')
+    def _commit_episode(self, item):
+        with self.lock:
+            item['ep'] += 1
+            self.history.save(2)
+
+    def _run_episode(self, item):
         # cmd = f'{self.exec} --s {item["id"]} -e {item["ep"]} --dlsubs ru {"--skipdl" if item["skipdl"] else ""}'
         cmd = [self.exec, '--s', str(item["id"]), '-e', str(item["ep"]), '--dlsubs', 'ru']
         if item['skipdl']: cmd.append('--skipdl')
         print(cmd)
-        res = check_output(cmd).decode('utf-8')
-        print(f'Download result:\n{res}')
-        return 'Subtitle downloaded' in res
+        found, denied = False, False
+        # output is shown as it comes, the episode only counts once the tool exits cleanly
+        with Popen(cmd, stdout=PIPE, stderr=STDOUT, encoding='utf-8', errors='replace') as proc:
+            for line in proc.stdout:
+                print(f'[{item["title"]}] {line.rstrip()}')
+                if self.DONE_MARKER in line: found = True
+                if self.AUTH_ERROR.search(line): denied = True
+            code = proc.wait()
+        return code, found, denied
+
+    def _dl_episode(self, item):
+        print(f'{"=" * 40}')
+        print(f'Downloading {item["ep"]} ep. of "{item["title"]}"')
+        for retry in (False, True):
+            authed_at = self.history.get_category('auth').get('authed_at', 0)
+            code, found, denied = self._run_episode(item)
+            if code == 0 and found:
+                self._commit_episode(item)
+                return True
+            # a rejected token is renewed once, then the episode is tried again
+            if retry or not denied or not self._autorize(force=True, seen=authed_at): break
+            print(f'[{item["title"]}] Auth rejected, retrying after a new --auth')
+        if code: print(f'[{item["title"]}] Failed with exit code {code}')
+        return False
+
+    def _dl_title(self, item):
+        while self._dl_episode(item): pass
 
     def download_titles(self):
-        self._autorize()
+        if not self._autorize(): return
         items = self.history.get_category('items')
-        for item in items.values():
-            dl_result = True
-            while dl_result:
-                dl_result = self._dl_episode(item)
-                if dl_result:
-                    item['ep'] += 1
-                    self.history.save(2)
+        # titles run side by side, episodes of one title stay in order
+        with ThreadPoolExecutor(self.workers) as executor: list(executor.map(self._dl_title, items.values()))
 
     def search(self, title):
         self._autorize()
@@ -52,6 +94,7 @@ def args_parse():
     parser = ArgumentParser(description='CrunchyRoll download helper')
     parser.add_argument('--work_dir', type=str, required=False, default='D:\\MediaTools\\crunchy-dl-nx')
     parser.add_argument('--title', type=str, required=False, default='download')
+    parser.add_argument('--workers', type=int, required=False, default=3)
     args = parser.parse_args()
     print(args)
     return args
@@ -59,7 +102,7 @@ def args_parse():
 
 def main():
     args = args_parse()
-    crunchyDl = CrunchyDL(args.work_dir)
+    crunchyDl = CrunchyDL(args.work_dir, workers=args.workers)
 
     if args.title == 'download':
         crunchyDl.download_titles()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from argparse import ArgumentParser
+from heapq import heappush, heappop
+from traceback import print_exc
+
+from commons import *
+from danbooru_dl import Danbooru
+from nnm_topic_utils import NNMTopicUtils
+from pixiv_dl import Pixiv
+from yandere_dl import Pooler, Poster, get_tagger
+
+
+# daemon.json: {"work_dir": "...", "workers": 4, "dedup": true,
+#               "jobs": [{"name": "yandere_posts", "every": 21600, "params": {"tags": ["tag_a", "tag_b"]}}, ...]}
+class Daemon:
+    # runs the configured jobs on their intervals in one process, downloaders and their logins live between runs
+    JOBS = ('yandere_tags', 'yandere_pools', 'yandere_posts', 'danbooru_posts', 'pixiv_posts',
+            'nnm_category', 'nnm_download', 'tele_danbooru', 'tele_chat')
+
+    def __init__(self, config):
+        self.work_dir = config.get('work_dir', WORK_DIR)
+        self.workers = config.get('workers', 1)
+        self.jobs = config['jobs']
+        for job in self.jobs:
+            if job['name'] not in self.JOBS: raise ValueError('Unknown job: %s' % job['name'])
+            if not isinstance(job.get('every'), (int, float)) or job['every'] <= 0:
+                raise ValueError('Job %s needs a positive "every" in seconds' % job['name'])
+        self.instances = {}
+
+    def _get(self, name, factory):
+        if name not in self.instances: self.instances[name] = factory()
+        return self.instances[name]
+
+    def _telethon(self):
+        def connect():
+            # telethon is only needed when a telegram job is configured
+            from tele_dl import TelethonDL
+            teleton = TelethonDL(self.work_dir)
+            teleton.connect()
+            return teleton
+        return self._get('telethon', connect)
+
+    def yandere_tags(self, update_all=False):
+        get_tagger(workers=self.workers).update_tags(update_all)
+
+    def yandere_pools(self, load_all=False):
+        pooler = self._get('pooler', lambda: Pooler(self.work_dir, workers=self.workers))
+        pooler.load_info(load_all)
+        pooler.download_pools()
+
+    def yandere_posts(self, tags, full_sweep=False):
+        poster = self._get('poster', lambda: Poster(self.work_dir, workers=self.workers))
+        for tag in tags: poster.download_posts(tag, full_sweep)
+
+    def danbooru_posts(self, tags, async_dl=False, full_sweep=False):
+        danbooru = self._get('danbooru', lambda: Danbooru(self.work_dir))
+        for tag in tags: danbooru.download_posts(tag, async_dl, full_sweep)
+
+    def pixiv_posts(self, post_ids, load_all=True, full_sweep=False):
+        pixiv = self._get('pixiv', lambda: Pixiv(self.work_dir, workers=max(self.workers, 4)))
+        for post_id in post_ids: pixiv.download_posts(post_id, load_all, full_sweep)
+
+    def _nnm(self):
+        # logins are kept by the instance and reused until LOGIN_TTL runs out
+        return self._get('nnm', lambda: NNMTopicUtils(self.work_dir))
+
+    def nnm_category(self, category, all_users=False, full=False):
+        self._nnm().update_category(category, all_users=all_users, full=full)
+
+    def nnm_download(self, category, forum, free_only=False, dl_idx=0, all_users=False):
+        self._nnm().download_torrents(category, forum, free_only, dl_idx, all_users)
+
+    def tele_danbooru(self, cnt=50):
+        self._telethon().download_danbooru_arts(cnt)
+
+    def tele_chat(self, subj, cnt=50, workers=1):
+        self._telethon().download_chat_arts(subj, cnt, workers)
+
+    def run(self):
+        queue = []
+        for i, job in enumerate(self.jobs): heappush(queue, (monotonic(), i))
+        while queue:
+            due, i = heappop(queue)
+            if due > monotonic(): sleep(due - monotonic())
+            job = self.jobs[i]
+            print('Daemon[%s] Running job with %s' % (job['name'], job.get('params', {})))
+            try:
+                getattr(self, job['name'])(**job.get('params', {}))
+            except Exception:
+                # one failing job doesn't stop the others, it's tried again on its next turn
+                print_exc()
+            heappush(queue, (max(due + job['every'], monotonic()), i))
+
+
+def args_parse():
+    parser = ArgumentParser(description='Runs downloader jobs on intervals in one process')
+    parser.add_argument('--config', type=str, default=join(BASE_DIR, 'daemon.json'))
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def main():
+    args = args_parse()
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = load(f)
+    if config.get('dedup'): use_file_index(FileIndex())
+    Daemon(config).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,96 +1,128 @@
 # -*- coding: utf-8 -*-
 from argparse import ArgumentParser
-from re import findall
-from urllib import parse
-
-from bs4 import BeautifulSoup as bs
-from requests import request
+from asyncio import gather, get_running_loop, run
 
 from commons import *
 
 MAIN_URL = 'https://danbooru.donmai.us'
+SITE = 'danbooru.donmai.us'
+PAGE_LIMIT = 200
+RATE = 10.0
 
 
-def _request_page(page_url):
-    resp = request('GET', page_url, proxies=PROXIES)
+def _request_posts(page_url, params):
+    # an empty list is the end of the listing, None a page that failed
+    resp = get_session(SITE, rate=RATE).get(page_url, params=params)
     if resp.status_code == 200:
-        return bs(resp.text, features='html.parser')
-    print('Page[%10d] Not found: %s' % (0, page_url))
-
+        return resp.json()
+    print('Page[%10d] Not found: %s' % (0, resp.url))
 
-def _get_links(page):
-    articles = page.find_all('article', class_='post-preview')
-    articles = map(lambda a: int(a.get('data-id')),
-                   filter(lambda a: 'duplicate' not in a.get('data-tags'), articles))
-    next_page = page.find('a', class_='paginator-next')
-    return list(articles), MAIN_URL + next_page.get('href') if next_page else None
 
-
-def _get_post_data(post_id, page):
+def _get_post_data(post):
     tags = []
-
-    div = page.find('div', class_='tag-list categorized-tag-list')
-    ul_a = div.find('ul', class_='artist-tag-list')
-    if ul_a: tags += [li.get('data-tag-name') for li in ul_a.find_all('li')]
-    ul_c = div.find('ul', class_='character-tag-list')
-    if ul_c: tags += [li.get('data-tag-name') for li in ul_c.find_all('li')]
-    ul_w = div.find('ul', class_='copyright-tag-list')
-    if ul_w: tags += [li.get('data-tag-name') for li in ul_w.find_all('li')]
-    # ul_g = div.find('ul', class_='general-tag-list')
-    # if ul_g: tags += [li.get('data-tag-name') for li in ul_g.find_all('li')]
+    tags += post['tag_string_artist'].split()
+    tags += post['tag_string_character'].split()
+    tags += post['tag_string_copyright'].split()
+    # tags += post['tag_string_general'].split()
     tags = cut_tags(tags)
 
-    url = page.find('li', attrs={'id': 'post-info-size'}).find('a').get('href')
-    ext = findall(r'(?:\w*)\.(\w{3,4})', url.split('/')[-1])[0]
-    file_name = '%d %s.%s' % (post_id, ' '.join(tags).replace('／', '_').replace('：', ''), ext)
+    file_name = '%d %s.%s' % (post['id'], ' '.join(tags).replace('／', '_').replace('：', ''), post['file_ext'])
 
-    return {'url': url, 'file': file_name}
+    return {'url': post['file_url'], 'file': file_name, 'md5': post.get('md5')}
 
 
 class Danbooru:
-    PAGE_URL = 'https://danbooru.donmai.us/posts?limit=200&tags=%s'
-    POST_URL = 'https://danbooru.donmai.us/posts/%d'
+    PAGE_URL = MAIN_URL + '/posts.json'
+    SAVE_EVERY = 50
 
     def __init__(self, work_dir=WORK_DIR, history=None):
         self.work_dir = work_dir
-        self.history = history if history else History(file_name='danbooru.json')
+        self.history = history if history else make_history(file_name='danbooru.json')
         self.limit_pages = None
-
-    def _collect_posts(self, tag):
-        result = []
-        next_url = self.PAGE_URL % parse.quote_plus(tag)
-        while next_url:
-            page = _request_page(next_url)
-            if not page: break
-            posts, next_url = _get_links(page)
-            # print('Post[%10d] Found %d posts on page [%s]' % (0, len(posts), next_url))
-            result += posts
+        self.complete = True
+        self.session = get_session(SITE, rate=RATE)
+        self.lock = Lock()
+
+    def _collect_posts(self, tag, stop=None):
+        result = {}
+        params = {'limit': PAGE_LIMIT, 'tags': tag}
+        self.complete = True
+        while True:
+            posts = _request_posts(self.PAGE_URL, params)
+            if posts is None: self.complete = False
+            if not posts: break
+            for post in posts:
+                # file_url is missing for posts hidden from the current account level
+                if 'duplicate' in post['tag_string'] or not post.get('file_url'): continue
+                result[post['id']] = _get_post_data(post)
+            # a short page isn't the end, posts hidden from the account are left out of the listing
+            if stop and stop(post['id'] for post in posts): break
+            params['page'] = 'b%d' % min(post['id'] for post in posts)
         print('Post[%10d] Found %d total posts' % (0, len(result)))
         return result
 
-    def _download_post(self, dir_path, post_id):
-        resp = request('GET', self.POST_URL % post_id, proxies=PROXIES)
-        if resp.status_code == 200:
-            post = _get_post_data(post_id, bs(resp.text, features='html.parser'))
-            if post['url']:
-                resp = request('GET', post['url'], stream=True, proxies=PROXIES)
-                if resp.status_code == 200:
-                    return dl_file(resp, dir_path, post['file'], post_id)
-
-    def download_posts(self, tag):
+    def _download_post(self, dir_path, post_id, post):
+        return dl_url(self.session, post['url'], dir_path, post['file'], post_id, post['md5'])
+
+    async def _download_posts_async(self, tag, mark, dir_path, posts):
+        # each post is recorded as soon as it's done, one failing post doesn't cancel the rest
+        done, loop = [0], get_running_loop()
+
+        async def download(post_id, post):
+            result = await session.dl_url(post['url'], dir_path, post['file'], post_id, post['md5'])
+            self._commit_post(tag, mark, post_id, result)
+            done[0] += 1
+            # history is written on the executor, commits made meanwhile wait for it on the lock
+            if done[0] % self.SAVE_EVERY == 0: await loop.run_in_executor(None, self._save)
+
+        async with AsyncSession(rate=RATE) as session:
+            results = await gather(*[download(post_id, post) for post_id, post in posts.items()],
+                                   return_exceptions=True)
+        for post_id, result in zip(posts.keys(), results):
+            if isinstance(result, Exception):
+                print('Post[%10d] Failed to download: %s' % (post_id, result))
+                mark.fail(post_id)
+
+    def _commit_post(self, tag, mark, post_id, result):
+        with self.lock:
+            if result:
+                self.history.add('posts', tag, post_id)
+            else:
+                mark.fail(post_id)
+
+    def _save(self):
+        with self.lock: self.history.save()
+
+    def download_posts(self, tag, async_dl=False, full_sweep=False):
         print('Post[%10d] Downloading tag [%s]' % (0, tag))
         dir_path = make_tag_dir(self.work_dir, tag)
-        posts_ = self.history.get_item('posts', tag, [])
-        posts = self._collect_posts(tag)
-        for post_id in posts:
-            if post_id in posts_: continue
-            if self._download_post(dir_path, post_id): posts_.append(post_id)
-            self.history.save()
+        mark = Watermark(self.history, SITE + ':' + tag, full_sweep)
+        posts = self._collect_posts(tag, None if mark.full else mark.reached)
+        complete = self.complete
+        mark.reached(posts.keys())
+        if mark.retry and not mark.full:
+            posts.update(self._collect_posts('id:' + ','.join(map(str, sorted(mark.retry)))))
+            # retries that couldn't be listed stay for the next run
+            if not self.complete:
+                for post_id in mark.retry.difference(posts.keys()): mark.fail(post_id)
+        posts = {post_id: post for post_id, post in posts.items()
+                 if not mark.below(post_id) and not self.history.contains('posts', tag, post_id)}
+        if async_dl:
+            run(self._download_posts_async(tag, mark, dir_path, posts))
+        else:
+            for i, (post_id, post) in enumerate(posts.items()):
+                self._commit_post(tag, mark, post_id, self._download_post(dir_path, post_id, post))
+                if i % self.SAVE_EVERY == self.SAVE_EVERY - 1: self.history.save()
+        mark.commit(complete)
+        self.history.save()
 
 
 def args_parse():
     parser = ArgumentParser(description='danbooru imageboard downloader')
     parser.add_argument('--work_dir', type=str, default=WORK_DIR)
+    parser.add_argument('--dedup', required=False, action='store_true')
+    parser.add_argument('--async_dl', required=False, action='store_true')
+    parser.add_argument('--full_sweep', required=False, action='store_true')
     parser.add_argument('--tags', type=str)
     parser.add_argument('--tag', type=str)
     args = parser.parse_args()
@@ -100,15 +132,18 @@ def args_parse():
 
 def main():
     args = args_parse()
+    file_index = use_file_index(FileIndex()) if args.dedup else None
 
     if args.tags:
         poster = Danbooru(args.work_dir)
         for tag in args.tags.split(','):
-            poster.download_posts(tag)
+            poster.download_posts(tag, args.async_dl, args.full_sweep)
 
     if args.tag:
         poster = Danbooru(args.work_dir)
-        poster.download_posts(args.tag)
+        poster.download_posts(args.tag, args.async_dl, args.full_sweep)
+
+    if file_index: file_index.report()
 
 
 if __name__ == '__main__':
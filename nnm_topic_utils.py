@@ -1,16 +1,86 @@
 # -*- coding: utf-8 -*-
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from re import findall
 
+import numpy as np
 from brotli import decompress
-from time import sleep
-
-from bs4 import BeautifulSoup as bs
-from requests import request
 
 from commons import *
 
 
+class TopicIndex:
+    # topics of one category as columns, forums are rows of their own and topics point at them by position
+    MEDALS = (None, 'bronze', 'silver', 'gold', 'platinum')
+    FREE = ('platinum', 'gold')
+    COLUMNS = ('t_ids', 'dl_ids', 'alive', 'bytes', 'medals', 'forums', 'f_ids', 'parents', 'names', 'name')
+
+    def __init__(self, columns):
+        for key in self.COLUMNS: setattr(self, key, columns[key])
+
+    @classmethod
+    def _medal(cls, medal):
+        return cls.MEDALS.index(medal) if medal in cls.MEDALS else -1
+
+    @classmethod
+    def from_struct(cls, c):
+        f_ids, parents, names, rows = [], [], [], []
+
+        def add(f, parent):
+            idx = len(f_ids)
+            f_ids.append(int(f['f_id']))
+            parents.append(parent)
+            names.append(f['name'])
+            rows.extend((int(t['t_id']), t['dl_id'], t['alive'], t['bytes'], cls._medal(t['medal']), idx)
+                        for t in (f.get('topics') or {}).values())
+            return idx
+
+        for c_f in c['forums'].values():
+            idx = add(c_f, -1)
+            for f in c_f['forums'].values(): add(f, idx)
+        t_ids, dl_ids, alive, bytes_, medals, forums = zip(*rows) if rows else ((),) * 6
+        return cls({'t_ids': np.array(t_ids, np.int64), 'dl_ids': np.array(dl_ids, np.int64),
+                    'alive': np.array(alive, np.bool_), 'bytes': np.array(bytes_, np.int64),
+                    'medals': np.array(medals, np.int8), 'forums': np.array(forums, np.int32),
+                    'f_ids': np.array(f_ids, np.int64), 'parents': np.array(parents, np.int32),
+                    'names': np.array(names, np.str_), 'name': np.array(c['name'], np.str_)})
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data: return cls({key: data[key] for key in cls.COLUMNS})
+
+    def save(self, file_path):
+        np.savez_compressed(file_path, **{key: getattr(self, key) for key in self.COLUMNS})
+
+    def stats(self):
+        # alive_cnt, total_cnt, alive_bytes, total_bytes per forum, category forums include their subforums
+        n = len(self.f_ids)
+        own = np.stack([np.bincount(self.forums, weights=w, minlength=n) for w in (
+            self.alive, self.dl_ids > 0, self.bytes * self.alive, self.bytes)], axis=1).astype(np.int64)
+        stats = own.copy()
+        sub = self.parents >= 0
+        np.add.at(stats, self.parents[sub], own[sub])
+        return stats, stats[~sub].sum(axis=0)
+
+    def topics(self, f_id):
+        # own topics of one forum in the shape the crawl gives them, without names and size strings
+        idx = np.flatnonzero(self.f_ids == int(f_id))
+        if not len(idx): return {}
+        mask = self.forums == idx[0]
+        return {str(t_id): {'t_id': str(t_id), 'dl_id': int(dl_id), 'alive': bool(alive), 'bytes': int(bytes_),
+                            'medal': self.MEDALS[medal] if medal >= 0 else None}
+                for t_id, dl_id, alive, bytes_, medal in zip(self.t_ids[mask], self.dl_ids[mask], self.alive[mask],
+                                                              self.bytes[mask], self.medals[mask])}
+
+    def select(self, f_id, free_only=False):
+        idx = np.flatnonzero(self.f_ids == int(f_id))
+        if not len(idx): return []
+        mask = ((self.forums == idx[0]) | (self.parents[self.forums] == idx[0])) & (self.dl_ids > 0)
+        if free_only: mask &= np.isin(self.medals, [self._medal(medal) for medal in self.FREE])
+        return [{'t_id': str(t_id), 'dl_id': int(dl_id)} for t_id, dl_id in zip(self.t_ids[mask], self.dl_ids[mask])]
+
+
 class NNMTopicUtils:
     ORIGIN = 'nnmclub.to'
     URL = 'https://%s/forum/' % ORIGIN
@@ -21,11 +91,12 @@ class NNMTopicUtils:
     TOPIC = 'viewtopic.php'
     DL = 'download.php'
 
-    RETRIES = 3
-    RETRY_TIMEOUT = 15
-    WAIT_TIMEOUT = 1.0
+    RATE = 1.0
+    LOGIN_TTL = 6 * 3600
     TOPISC_PER_PAGE = 50
+    SAVE_EVERY = 50
 
+    AGGREGATES = ('alive_cnt', 'total_cnt', 'topics_cnt', 'alive_bytes', 'total_bytes')
     LINE_FMT = '%-50s — %-18s — %-18s'
     STAT_FMT = '%5d (%s)'
 
@@ -44,27 +115,53 @@ class NNMTopicUtils:
 
     def __init__(self, work_dir=WORK_DIR, history=None):
         self.work_dir = work_dir
-        self.history = history if history else History(file_name='nnm_topic_utils.json')
+        self.history = history if history else make_history(file_name='nnm_topic_utils.json')
         self.user, self.password, self.sid, self.cookies = None, None, None, {}
+        self.session = None
+        self.accounts = None
+        self.logins = {}
         with open(join(BASE_DIR, 'cookies', 'nnm_.json'), 'r') as f:
             self.users = list(load(f).items())
         self.sizer = Sizer()
+        self.cache = get_response_cache()
 
     def _select_user(self, idx):
+        self.accounts = None
         self.user, self.password = self.users[idx]
-        return self._login()
-
-    def _request(self, page_url, referer, params=None, data=None, method='GET'):
-        self.HEADERS['Referer'] = referer
-        for i in range(0, self.RETRIES):
-            try:
-                resp = request(method, page_url, params=params, data=data,
-                               headers=self.HEADERS, cookies=self.cookies, proxies=PROXIES)
-                if resp.status_code == 200: return resp
-                print('Failed to get page [%s] with params [%s]: %s' % (page_url, params, resp.text))
-            except Exception as e:
-                print('Failed to get page [%s] with params [%s]: %s' % (page_url, params, e))
-            sleep(self.RETRY_TIMEOUT * (i + 1))
+        self.session = get_session('%s:%s' % (self.ORIGIN, self.user), headers=self.HEADERS, rate=self.RATE)
+        # a recent login of the account is reused, clones share these through the same dict
+        login = self.logins.get(self.user)
+        if login and monotonic() - login[1] < self.LOGIN_TTL:
+            self.cookies = login[0]
+            # the site can drop a session early, a page without the user's name means logging in again
+            if self._get_me(self._get_page(self.URL + self.CATEGORY, self.URL + self.CATEGORY)): return True
+            print('Login[%s] Stored login expired' % self.user)
+        if not self._login(): return False
+        self.logins[self.user] = (self.cookies, monotonic())
+        return True
+
+    def _login_all(self):
+        # one clone per account, they share history and cache but keep their own session and cookies
+        self.accounts = []
+        for idx in range(len(self.users)):
+            account = copy(self)
+            if account._select_user(idx): self.accounts.append(account)
+        print('Login[%s] Logged in %d of %d accounts' % (self.ORIGIN, len(self.accounts), len(self.users)))
+        if not self.accounts: return False
+        # requests made outside of the shards go out as the first account
+        first = self.accounts[0]
+        self.user, self.password, self.session, self.cookies = first.user, first.password, first.session, first.cookies
+        return True
+
+    def _request(self, page_url, referer, params=None, data=None, method='GET', headers=None):
+        # pacing and retries of 429/5xx/network errors are left to the session's rate limiter
+        try:
+            resp = self.session.request(method, page_url, params=params, data=data,
+                                        headers=dict(headers or {}, Referer=referer), cookies=self.cookies)
+            if resp.status_code == 200 or resp.status_code == 304 and headers: return resp
+            print('Failed to get page [%s] with params [%s]: %s' % (page_url, params, resp.text))
+        except Exception as e:
+            print('Failed to get page [%s] with params [%s]: %s' % (page_url, params, e))
 
     @staticmethod
     def _decompress(resp):
@@ -73,10 +170,17 @@ class NNMTopicUtils:
     def _get_page(self, page_url, referer, params=None, data=None, method='GET'):
         resp = self._request(page_url, referer, params, data, method)
         text = self._decompress(resp)
-        return bs(text, features='html.parser') if text else None
+        return parse_html(text) if text else None
+
+    def _get_cached(self, page_url, referer, parse, params=None):
+        # listing pages are revalidated with ETag/Last-Modified, an unchanged page isn't parsed again
+        return self.cache.fetch(self.cache.make_key(page_url, params),
+                                lambda headers: self._request(page_url, referer, params, headers=headers),
+                                parse, self._decompress)
 
     def _login(self):
         # Get login code
+        self.session.cookies.clear()
         self.cookies = {'ssl': 'enable_ssl'}
         page = self._get_page(self.URL + self.LOGIN,
                               self.URL + self.CATEGORY + '?redirect=' + self.CATEGORY)
@@ -88,7 +192,6 @@ class NNMTopicUtils:
             'login': page.find('input', attrs={'name': 'login'}).attrs.get('value')
         }
         print('Login[%s] Got login data: %s' % (self.user, form_data))
-        sleep(self.WAIT_TIMEOUT)
         # Do login
         resp = self._request(self.URL + self.LOGIN,
                              self.URL + self.LOGIN + '?redirect=' + self.CATEGORY,
@@ -97,8 +200,7 @@ class NNMTopicUtils:
         print('Login[%s] Login result: %d' % (self.user, resp.status_code))
         if resp.status_code != 200: return False
         text = self._decompress(resp)
-        page = bs(text, features='html.parser')
-        me = page.findAll('a', class_='mainmenu')[12].text[8:-2]
+        me = self._get_me(parse_html(text))
         if not me:
             print('Failed to login')
             return False
@@ -106,6 +208,12 @@ class NNMTopicUtils:
         self.cookies = {key: self.cookies.get(key) for key in self.cookies.keys()}
         return True
 
+    @staticmethod
+    def _get_me(page):
+        # name of the logged in user from the main menu, a guest page has fewer entries
+        menu = page.findAll('a', class_='mainmenu') if page else []
+        return menu[12].text[8:-2] if len(menu) > 12 else None
+
     @staticmethod
     def _get_id(link):
         return link.split('=')[1]
@@ -121,30 +229,24 @@ class NNMTopicUtils:
         return int(pager[-2].text) if pager else 1
 
     @staticmethod
-    def _calc_size(topics):
-        alive, total = 0, 0
+    def _count_topics(topics):
+        # one pass over the topic dicts for all counters of a forum
+        alive_cnt, total_cnt, alive_bytes, total_bytes = 0, 0, 0, 0
         for t in topics.values():
-            if t['alive']: alive += t['bytes']
-            total += t['bytes']
-        return alive, total
-
-    @staticmethod
-    def _get_dl_topics(topics):
-        return list(filter(lambda t: t['dl_id'] > 0, topics.values()))
-
-    @staticmethod
-    def _get_alive_topics(topics):
-        return list(filter(lambda t: t['alive'], topics.values()))
-
-    @staticmethod
-    def _get_free_topic(topics):
-        return list(filter(lambda t: t['medal'] in ('platinum', 'gold'), topics))
+            if t['alive']:
+                alive_cnt += 1
+                alive_bytes += t['bytes']
+            if t['dl_id'] > 0: total_cnt += 1
+            total_bytes += t['bytes']
+        return alive_cnt, total_cnt, alive_bytes, total_bytes
 
     def _get_forums(self, heads):
         forums = {}
         for h in heads:
+            # listed_cnt keeps the counter as the forum list shows it, topics_cnt becomes the crawled count
+            topics_cnt = int(h.parent.parent.findAll('td', class_='row2')[0].text)
             f = {'f_id': self._get_id(h.find('a').get('href')), 'name': h.text,
-                 'topics_cnt': int(h.parent.parent.findAll('td', class_='row2')[0].text),
+                 'topics_cnt': topics_cnt, 'listed_cnt': topics_cnt,
                  'alive_cnt': 0, 'total_cnt': 0, 'alive_bytes': 0, 'total_bytes': 0,
                  'alive_size': None, 'total_size': None, 'topics': [], 'forums': []}
             forums[f['f_id']] = f
@@ -167,98 +269,147 @@ class NNMTopicUtils:
                     t['medal'] = self._get_medal(h)
         return topics
 
-    def _get_forum_topics(self, f_id, topics_cnt):
-        result = {}
-        for i in range(0, int(topics_cnt / self.TOPISC_PER_PAGE) + 1):
-            print('Forum[%s] get page %d' % (f_id, i + 1))
-            page = self._get_page(self.URL + self.FORUM, self.URL + self.CATEGORY,
-                                  params={'f': f_id, 'start': i * self.TOPISC_PER_PAGE})
-            topics = self._get_topics(page.findAll('h2', class_='topictitle'))
-            print('Forum[%s] found %d topics' % (f_id, len(topics)))
-            result.update(topics)
-            sleep(self.WAIT_TIMEOUT)
-        print('Forum[%s] found %d total topics' % (f_id, len(result)))
-        return result
+    def _parse_topics(self, text):
+        return self._get_topics(parse_html(text).findAll('h2', class_='topictitle'))
+
+    def _get_forum_page(self, f_id, i):
+        print('Forum[%s] get page %d' % (f_id, i + 1))
+        topics = self._get_cached(self.URL + self.FORUM, self.URL + self.CATEGORY, self._parse_topics,
+                                  params={'f': f_id, 'start': i * self.TOPISC_PER_PAGE}) or {}
+        print('Forum[%s] found %d topics' % (f_id, len(topics)))
+        return topics
+
+    def _get_forum_pages(self, f_id, topics_cnt):
+        return [(f_id, i) for i in range(0, int(topics_cnt / self.TOPISC_PER_PAGE) + 1)]
 
     def _get_category_forum(self, cf_id, c_f):
+        # the forum page is also the first page of its own topics
         page = self._get_page(self.URL + self.FORUM, self.URL + self.CATEGORY, params={'f': cf_id})
-        pages_cnt = self._get_pages_count(page)
         c_f['forums'] = self._get_forums(page.findAll('h2', class_='forumlink'))
-        c_f['topics'] = self._get_forum_topics(cf_id, pages_cnt * self.TOPISC_PER_PAGE - 1)
-        c_f['alive_bytes'], c_f['total_bytes'] = self._calc_size(c_f['topics'])
-        c_f['alive_cnt'] = len(self._get_alive_topics(c_f['topics']))
-        c_f['total_cnt'] = len(self._get_dl_topics(c_f['topics']))
-        c_f['topics_cnt'] = len(c_f['topics'])
-        for f_id, f in c_f['forums'].items():
-            f['topics'] = self._get_forum_topics(f_id, f['topics_cnt'])
-            f['alive_bytes'], f['total_bytes'] = self._calc_size(f['topics'])
+        c_f['pages_cnt'] = self._get_pages_count(page)
+        return self._get_topics(page.findAll('h2', class_='topictitle'))
+
+    def _sharded(self, func, jobs):
+        # every logged in account pulls jobs from one queue on its own thread, each paced by its own session
+        accounts = self.accounts or [self]
+        jobs_, lock, results = iter(jobs), Lock(), {}
+
+        def run(account):
+            while True:
+                with lock: job = next(jobs_, None)
+                if job is None: return
+                results[job] = func(account, *job)
+
+        with ThreadPoolExecutor(len(accounts)) as executor: list(executor.map(run, accounts))
+        return results
+
+    def _sum_forum(self, f, topics):
+        f['topics'] = topics
+        f['alive_cnt'], f['total_cnt'], f['alive_bytes'], f['total_bytes'] = self._count_topics(topics)
+        f['alive_size'] = self.sizer.format_size(f['alive_bytes'])
+        f['total_size'] = self.sizer.format_size(f['total_bytes'])
+        f['topics_cnt'] = len(topics)
+
+    def _patch(self, parent, old, new):
+        # moves the parent's counters by the difference one child made instead of summing all children again
+        for key in self.AGGREGATES: parent[key] += (new[key] if new else 0) - (old[key] if old else 0)
+        parent['alive_size'] = self.sizer.format_size(parent['alive_bytes'])
+        parent['total_size'] = self.sizer.format_size(parent['total_bytes'])
+
+    @staticmethod
+    def _first_page(topics):
+        # order and seed/size stats of the first page topics, a bump or a seed change shows up here
+        return [[t_id, t['dl_id'], t['alive'], t['bytes']] for t_id, t in topics.items()]
+
+    def _is_changed(self, old, first_page, key, value):
+        # a forum whose listed counter and first page are the same as stored is taken over unchanged,
+        # stats of topics beyond the first page are then only refreshed with the next change or a full refresh
+        return old is None or old.get(key) != value or old.get('first_page') != self._first_page(first_page)
+
+    @staticmethod
+    def _merge_pages(pages, jobs):
+        topics = {}
+        for job in jobs: topics.update(pages[job])
+        print('Forum[%s] found %d total topics' % (jobs[0][0], len(topics)))
+        return topics
+
+    def _refresh_forum(self, f, old, pages, changed, topics_cnt, old_topics):
+        f['first_page'] = self._first_page(pages[(f['f_id'], 0)])
+        if f['f_id'] in changed:
+            self._sum_forum(f, self._merge_pages(pages, self._get_forum_pages(f['f_id'], topics_cnt)))
+        else:
+            f['topics'] = old_topics(f['f_id'])
+            for key in self.AGGREGATES: f[key] = old[key]
             f['alive_size'] = self.sizer.format_size(f['alive_bytes'])
             f['total_size'] = self.sizer.format_size(f['total_bytes'])
-            f['alive_cnt'] = len(self._get_alive_topics(f['topics']))
-            f['total_cnt'] = len(self._get_dl_topics(f['topics']))
-            f['topics_cnt'] = len(f['topics'])
-            c_f['alive_cnt'] += len(self._get_alive_topics(f['topics']))
-            c_f['total_cnt'] += len(self._get_dl_topics(f['topics']))
-            c_f['topics_cnt'] += len(f['topics'])
-            c_f['alive_bytes'] += f['alive_bytes']
-            c_f['total_bytes'] += f['total_bytes']
-        c_f['alive_size'] = self.sizer.format_size(c_f['alive_bytes'])
-        c_f['total_size'] = self.sizer.format_size(c_f['total_bytes'])
+
+    def _merge_category_forum(self, c_f, old_cf, pages, changed, old_topics):
+        own, old_own = {'f_id': c_f['f_id']}, None
+        if old_cf:
+            # stored counters of a category forum include its subforums, what's left is its own topics
+            old_own = {key: old_cf[key] - sum(f[key] for f in old_cf['forums'].values()) for key in self.AGGREGATES}
+        self._refresh_forum(own, old_own, pages, changed, c_f['pages_cnt'] * self.TOPISC_PER_PAGE - 1, old_topics)
+        for key in self.AGGREGATES: c_f[key] = old_cf[key] if old_cf else 0
+        c_f['topics'], c_f['first_page'] = own['topics'], own['first_page']
+        self._patch(c_f, old_own, own)
+        old_forums = old_cf['forums'] if old_cf else {}
+        for f_id, f in c_f['forums'].items():
+            self._refresh_forum(f, old_forums.get(f_id), pages, changed, f['listed_cnt'], old_topics)
+            self._patch(c_f, old_forums.get(f_id), f)
+        for f_id, f in old_forums.items():
+            if f_id not in c_f['forums']: self._patch(c_f, f, None)
         return c_f
 
-    def _get_category(self, c_id):
+    def _get_category(self, c_id, old=None, old_topics=None):
         page = self._get_page(self.URL + self.CATEGORY, self.URL + self.CATEGORY, params={'c': c_id})
         name = page.find('tr', attrs={'onclick': 'CFIG_slideCat(\'%s\', false);' % c_id}).text.strip()
         c = self._get_forums(page.findAll('h3', class_='forumlink'))
-        topics_cnt, alive_cnt, total_cnt, alive_bytes, total_bytes = 0, 0, 0, 0, 0
+        old_forums = old['forums'] if old else {}
+        first_pages = self._sharded(lambda account, f_id: account._get_category_forum(f_id, c[f_id]),
+                                    [(f_id,) for f_id in c])
+        pages = {(f_id, 0): first_pages[(f_id,)] for f_id in c}
+        pages.update(self._sharded(lambda account, f_id, i: account._get_forum_page(f_id, i),
+                                   [(f_id, 0) for f in c.values() for f_id in f['forums']]))
+        changed, jobs = set(), []
         for f_id, f in c.items():
-            f = self._get_category_forum(f_id, f)
-            topics_cnt += f['topics_cnt']
-            alive_cnt += f['alive_cnt']
-            total_cnt += f['total_cnt']
-            alive_bytes += f['alive_bytes']
-            total_bytes += f['total_bytes']
-        return {'c_id': c_id, 'name': name, 'topics_cnt': topics_cnt,
-                'alive_cnt': alive_cnt, 'total_cnt': total_cnt,
-                'alive_bytes': alive_bytes, 'total_bytes': total_bytes,
-                'alive_size': self.sizer.format_size(alive_bytes),
-                'total_size': self.sizer.format_size(total_bytes), 'forums': c}
-
-    def _flatten_category(self, c_id, limit=None):
-        forums = {}
-        category = self.history.get_item('struct', c_id)
-        for c_f in category['forums'].values():
-            topics = self._get_dl_topics(c_f['topics'])
-            if limit: topics = topics[:limit]
-            for f in c_f['forums'].values():
-                topics_ = self._get_dl_topics(f['topics'])
-                forums[f['f_id']] = topics_[:limit] if limit else topics_
-                topics += forums[f['f_id']]
-            forums[c_f['f_id']] = topics
-        return forums
+            old_f = old_forums.get(f_id)
+            if self._is_changed(old_f, pages[(f_id, 0)], 'pages_cnt', f['pages_cnt']):
+                changed.add(f_id)
+                jobs += self._get_forum_pages(f_id, f['pages_cnt'] * self.TOPISC_PER_PAGE - 1)[1:]
+            for f_id_, f_ in f['forums'].items():
+                old_f_ = old_f['forums'].get(f_id_) if old_f else None
+                if self._is_changed(old_f_, pages[(f_id_, 0)], 'listed_cnt', f_['listed_cnt']):
+                    changed.add(f_id_)
+                    jobs += self._get_forum_pages(f_id_, f_['listed_cnt'])[1:]
+        print('Category[%s] %d of %d forum(s) changed' % (c_id, len(changed), len(pages)))
+        pages.update(self._sharded(lambda account, f_id, i: account._get_forum_page(f_id, i), jobs))
+        result = {'c_id': c_id, 'name': name, 'forums': c}
+        for key in self.AGGREGATES: result[key] = old[key] if old else 0
+        for f_id, f in c.items():
+            old_f = old_forums.get(f_id)
+            self._patch(result, old_f, self._merge_category_forum(f, old_f, pages, changed, old_topics))
+        for f_id, f in old_forums.items():
+            if f_id not in c: self._patch(result, f, None)
+        return result
 
-    @staticmethod
-    def _list_check(t, history_item):
-        return t['dl_id'] in history_item
+    def _list_check(self, t, category, item):
+        return self.history.contains(category, item, t['dl_id'])
 
-    @staticmethod
-    def _list_commit(t, history_item):
-        history_item.append(t['dl_id'])
+    def _list_commit(self, t, category, item):
+        self.history.add(category, item, t['dl_id'])
 
     def _dl_torrent(self, t):
         resp = self._request(self.URL + self.DL, self.URL + self.TOPIC + '?t=' + t['t_id'],
                              params={'id': t['dl_id']})
-        if resp.status_code == 200:
+        if resp:
             file_name = findall(r'.*? filename="(.*)"', resp.headers.get('Content-Disposition'))[0]
             return dl_file(resp, self.work_dir, file_name, t['dl_id'])
 
     def _process_topics(self, topics, exec_func, category, item, **kwargs):
-        history_item = self.history.get_item(category, item, kwargs.get('default_item', []))
         for i, t in enumerate(topics):
-            if kwargs.get('check_func', self._list_check)(t, history_item): continue
+            if kwargs.get('check_func', self._list_check)(t, category, item): continue
             if exec_func(t, **kwargs):
-                kwargs.get('commit_func', self._list_commit)(t, history_item)
-                sleep(self.WAIT_TIMEOUT)
+                kwargs.get('commit_func', self._list_commit)(t, category, item)
             if i % 50 == 0: self.history.save()
         self.history.save()
 
@@ -267,32 +418,101 @@ class NNMTopicUtils:
                                 self.STAT_FMT % (f_['total_cnt'], f_['total_size']),
                                 self.STAT_FMT % (f_['alive_cnt'], f_['alive_size']))
 
+    def _index_path(self, c_id):
+        return join(BASE_DIR, 'nnm_topics_%s.npz' % c_id)
+
+    @staticmethod
+    def _has_topics(c):
+        return all('topics' in c_f for c_f in c['forums'].values())
+
+    @staticmethod
+    def _strip_topics(c):
+        # topics live in the index only, the struct keeps the forum tree, counters and first pages
+        for c_f in c['forums'].values():
+            c_f.pop('topics', None)
+            for f in c_f['forums'].values(): f.pop('topics', None)
+
+    def _get_index(self, c_id):
+        # the saved columns hold the topics, a struct stored before them still carries its own and is indexed once
+        if isfile(self._index_path(c_id)): return TopicIndex.load(self._index_path(c_id))
+        c = self.history.get_category('struct').get(c_id)
+        if not c or not self._has_topics(c):
+            print('Category[%s] No topic index, run a full update first' % c_id)
+            return None
+        index = TopicIndex.from_struct(c)
+        index.save(self._index_path(c_id))
+        return index
+
+    def _old_topics(self, c_id, old):
+        # topics of forums that didn't change are taken from the index, or from a struct stored before it
+        if isfile(self._index_path(c_id)): return TopicIndex.load(self._index_path(c_id)).topics
+        if not self._has_topics(old): return None
+        forums = {}
+        for c_f in old['forums'].values():
+            forums[c_f['f_id']] = c_f
+            forums.update(c_f['forums'])
+        return lambda f_id: forums[f_id]['topics']
+
+    def _make_forum(self, name, stats):
+        alive_cnt, total_cnt, alive_bytes, total_bytes = map(int, stats)
+        return {'name': name, 'alive_cnt': alive_cnt, 'total_cnt': total_cnt,
+                'alive_size': self.sizer.format_size(alive_bytes), 'total_size': self.sizer.format_size(total_bytes)}
+
     def print_stats(self, c_id):
-        c = self.history.get_item('struct', c_id)
+        index = self._get_index(c_id)
+        if index is None: return []
+        stats, total = index.stats()
         lines = [self.LINE_FMT % ('Форум', 'Всего раздач', '"Живых" раздач'),
-                 self._format_forum(c_id, c, 0)]
-        for c_f in c['forums'].values():
-            lines.append(self._format_forum(c_f['f_id'], c_f, 1))
-            for f in c_f['forums'].values():
-                lines.append(self._format_forum(f['f_id'], f, 2))
+                 self._format_forum(c_id, self._make_forum(index.name, total), 0)]
+        for i, (f_id, parent, name) in enumerate(zip(index.f_ids, index.parents, index.names)):
+            lines.append(self._format_forum(f_id, self._make_forum(name, stats[i]), 1 if parent < 0 else 2))
 
         for l in lines: print(l)
         with open(join(self.work_dir, 'cat_%s_stats.txt' % c_id), 'w') as f:
             f.writelines([l + '\n' for l in lines])
         return lines
 
-    def update_category(self, c_id, u_id=0):
-        if not self._select_user(u_id): return
-        c = self._get_category(c_id)
+    def update_category(self, c_id, u_id=0, all_users=False, full=False):
+        if not (self._login_all() if all_users else self._select_user(u_id)): return
+        # forums that didn't change keep their indexed topics, full rebuilds the struct from scratch
+        old = None if full else self.history.get_category('struct').get(c_id)
+        old_topics = self._old_topics(c_id, old) if old else None
+        c = self._get_category(c_id, old if old_topics else None, old_topics)
+        TopicIndex.from_struct(c).save(self._index_path(c_id))
+        self._strip_topics(c)
         self.history.set_item('struct', c_id, c)
         self.history.save()
         self.print_stats(c_id)
+        self.cache.report()
         return c
 
-    def download_torrents(self, c_id, f_id, free_only=False, u_id=0):
-        if not self._select_user(u_id): return
-        forums = self._flatten_category(c_id)
-        topics = self._get_free_topic(forums[f_id]) if free_only else forums[f_id]
+    def _is_downloaded(self, t):
+        return any(self.history.contains('downloads', user, t['dl_id']) for user, _ in self.users)
+
+    def _dl_sharded(self, topics):
+        # every topic is handed to exactly one account, progress goes to that account's downloads
+        lock, done = Lock(), [0]
+
+        def run(account, t_id, dl_id):
+            if not account._dl_torrent({'t_id': t_id, 'dl_id': dl_id}): return
+            with lock:
+                self.history.add('downloads', account.user, dl_id)
+                done[0] += 1
+                if done[0] % self.SAVE_EVERY == 0: self.history.save()
+
+        self._sharded(run, [(t['t_id'], t['dl_id']) for t in topics])
+        self.history.save()
+        print('Downloaded %d of %d torrents by %d accounts' % (done[0], len(topics), len(self.accounts)))
+
+    def download_torrents(self, c_id, f_id, free_only=False, u_id=0, all_users=False):
+        if not (self._login_all() if all_users else self._select_user(u_id)): return
+        index = self._get_index(c_id)
+        if index is None: return
+        topics = index.select(f_id, free_only)
+        if all_users:
+            # a torrent fetched earlier by any of the accounts isn't fetched again
+            self._dl_sharded([t for t in topics if not self._is_downloaded(t)])
+            return
         print('Downloading torrents by %s' % self.user)
         self._process_topics(topics, self._dl_torrent, 'downloads', self.user)
 
@@ -305,6 +525,8 @@ def args_parse():
     parser.add_argument('--free_only', required=False, action='store_true')
     parser.add_argument('--download', required=False, action='store_true')
     parser.add_argument('--dl_idx', required=False, type=int, default=0)
+    parser.add_argument('--all_users', required=False, action='store_true')
+    parser.add_argument('--full_refresh', required=False, action='store_true')
     parser.add_argument('--category', required=False, type=str)
     parser.add_argument('--forum', required=False, type=str)
     args = parser.parse_args()
@@ -317,13 +539,13 @@ def main():
     utils = NNMTopicUtils(args.work_dir)
 
     if args.update_category:
-        utils.update_category(args.category)
+        utils.update_category(args.category, all_users=args.all_users, full=args.full_refresh)
 
     if args.print_category:
         utils.print_stats(args.category)
 
     if args.download:
-        utils.download_torrents(args.category, args.forum, args.free_only, args.dl_idx)
+        utils.download_torrents(args.category, args.forum, args.free_only, args.dl_idx, args.all_users)
 
 
 if __name__ == '__main__':
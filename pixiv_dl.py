@@ -1,63 +1,94 @@
 # -*- coding: utf-8 -*-
 from argparse import ArgumentParser
-from json import loads
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from re import sub
-from time import sleep
-
-from bs4 import BeautifulSoup as bs
-from requests import request
+from zipfile import ZipFile
 
 from commons import *
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+UGOIRA_FORMATS = {'gif': ('GIF', 'gif'), 'webp': ('WEBP', 'webp'), 'apng': ('PNG', 'png')}
+
+
+def convert_ugoira(zip_path, frames, file_path, fmt):
+    # runs in a worker process, frames are decoded from the zip as the encoder asks for them,
+    # the WebP writer encodes them one by one while GIF and APNG keep every frame until the file is written
+    pil_format, _ = UGOIRA_FORMATS[fmt]
+    mode = 'RGB' if fmt == 'gif' else 'RGBA'
+    part_path = file_path + PART_EXT
+    with ZipFile(zip_path) as zf:
+        def images():
+            for frame in frames:
+                with zf.open(frame['file']) as fd:
+                    yield Image.open(fd).convert(mode)
+
+        images_ = images()
+        first = next(images_)
+        # the APNG writer only takes a list
+        if fmt == 'apng': images_ = list(images_)
+        first.save(part_path, format=pil_format, save_all=True, append_images=images_,
+                   duration=[frame['delay'] for frame in frames], loop=0)
+    return hash_file(part_path).hexdigest()
+
 
 class Pixiv:
     POST_URL = 'https://www.pixiv.net/en/artworks/%s'
+    ILLUST_URL = 'https://www.pixiv.net/ajax/illust/%s'
+    PAGES_URL = ILLUST_URL + '/pages'
+    PROFILE_URL = 'https://www.pixiv.net/ajax/user/%s/profile/all'
+    UGOIRA_URL = ILLUST_URL + '/ugoira_meta'
     HEADERS = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) '
                       'AppleWebKit/537.36 (KHTML, like Gecko) '
-                      'Chrome/79.0.3945.117 Safari/537.36',
-        'Referer': None
+                      'Chrome/79.0.3945.117 Safari/537.36'
     }
+    RATE = 3.0
+    SAVE_EVERY = 20
     EXCLUDE_TAGS = {'bookmarks', 'congratulation', 'congratulations', 'ugoira', 'manga'}
 
-    UGOIRA_DL_URL = 'http://ugoira.dataprocessingclub.org/convert'
-    UGOIRA_PARAMS = {'url': POST_URL, 'format': 'gif'}
-
-    def __init__(self, work_dir=WORK_DIR, history=None):
+    def __init__(self, work_dir=WORK_DIR, history=None, workers=4, ugoira_format='gif'):
         self.work_dir = work_dir
-        self.history = history if history else History(file_name='pixiv.json')
+        self.workers = workers
+        self.ugoira_format = ugoira_format
+        self.converter = None
+        self.history = history if history else make_history(file_name='pixiv.json')
         with open(join(BASE_DIR, 'cookies', 'pixiv_.json'), 'r') as fd:
             self.cookies = load(fd)
+        self.session = get_session('pixiv.net', cookies=self.cookies, headers=self.HEADERS, rate=self.RATE)
 
-    def _get_page(self, post_id):
-        self.HEADERS['Referer'] = self.POST_URL % post_id
-        resp = request('GET', self.HEADERS['Referer'], cookies=self.cookies, headers=self.HEADERS, proxies=PROXIES)
+    def _get_json(self, url, post_id):
+        resp = self.session.get(url, headers={'Referer': self.POST_URL % post_id})
         if resp.status_code == 200:
-            return bs(resp.text, features='html.parser')
-        else:
-            print('Post %s not found' % post_id)
-
-    @staticmethod
-    def _get_meta(page, post_id):
-        meta = page.find_all('meta')
-        for m in meta:
-            if m.attrs['content'].find('{') == 0:
-                m = loads(m.attrs['content'])
-                if m.get('illust'):
-                    return m
-        print('Meta not found for post %s' % post_id)
-
-    @staticmethod
-    def _save_meta(meta, post_id):
-        with open(join(BASE_DIR, '%d.json' % post_id), 'w', encoding='utf-8') as fd:
-            dump(meta, fd, ensure_ascii=False, indent=2)
-
-    @staticmethod
-    def _gen_urls(base_url, page_count):
-        idx = base_url.rfind('.')
-        path, ext = base_url[:idx], base_url[idx + 1:]
-        path = path[:-1] + '%d'
-        return ['%s.%s' % (path % i, ext) for i in range(0, page_count)], ext
+            data = resp.json()
+            if not data.get('error'): return data['body']
+        print('Post[%10s] Failed to get %s: %d' % (post_id, url, resp.status_code))
+
+    def _get_post(self, post_id):
+        return self._get_json(self.ILLUST_URL % post_id, post_id)
+
+    def _get_posts(self, executor, post_ids):
+        # metadata is looked up one chunk of works ahead of the downloads, not for every work at once
+        chunks = [post_ids[i:i + self.workers] for i in range(0, len(post_ids), self.workers)]
+        pending = executor.map(self._get_post, chunks[0]) if chunks else []
+        for i, chunk in enumerate(chunks):
+            posts = list(pending)
+            if i + 1 < len(chunks): pending = executor.map(self._get_post, chunks[i + 1])
+            yield from zip(chunk, posts)
+
+    def _get_links(self, post_id, post):
+        if post['pageCount'] == 1: return [post['urls']['original']]
+        pages = self._get_json(self.PAGES_URL % post_id, post_id)
+        return [page['urls']['original'] for page in pages] if pages else []
+
+    def _get_user_posts(self, user_id, post_id):
+        # one request lists every work of the artist, newest first
+        works = self._get_json(self.PROFILE_URL % user_id, post_id)
+        if not works: return []
+        return sorted(list(works['illusts'] or []) + list(works['manga'] or []), key=int, reverse=True)
 
     def _get_tag(self, tag):
         value = (tag['translation']['en'] if tag.get('translation') else tag.get('romaji', tag['tag']))
@@ -67,48 +98,82 @@ class Pixiv:
     def _get_tags(self, post):
         return list(filter(lambda t: t, [self._get_tag(tag) for tag in post['tags']['tags']]))
 
+    def _dl_ugoira(self, posts_dir, post_id, file):
+        if Image is None:
+            print('Post[%10s] Pillow is required to convert ugoira' % post_id)
+            return False
+        meta = self._get_json(self.UGOIRA_URL % post_id, post_id)
+        if not meta: return False
+        zip_path = join(posts_dir, '%s ugoira.zip%s' % (post_id, PART_EXT))
+        file_path = join(posts_dir, normalize(file))
+        try:
+            with self.session.get(meta['originalSrc'], headers={'Referer': self.POST_URL % post_id},
+                                  stream=True) as resp:
+                if resp.status_code != 200:
+                    print('Post[%10s] Failed to get ugoira frames: %d' % (post_id, resp.status_code))
+                    return False
+                with open(zip_path, 'wb') as fd:
+                    for chunk in resp.iter_content(CHUNK_SIZE): fd.write(chunk)
+            if self.converter is None: self.converter = ProcessPoolExecutor(1)
+            try:
+                digest = self.converter.submit(convert_ugoira, zip_path, meta['frames'], file_path,
+                                               self.ugoira_format).result()
+            except Exception as e:
+                print('Post[%10s] Failed to convert ugoira: %s' % (post_id, e))
+                return False
+        finally:
+            if exists(zip_path): remove(zip_path)
+        file_path = finish_file(file_path + PART_EXT, file_path, digest)
+        print('File[%10d] Converted ugoira: %s' % (int(post_id), basename(file_path)))
+        return True
+
+    def _download_page(self, posts_dir, post_id, tags, i, link):
+        ext = link[link.rfind('.') + 1:]
+        ugoira = link.find('ugoira') > 0
+        if ugoira: ext = UGOIRA_FORMATS[self.ugoira_format][1]
+        file = '%s p%03d %s.%s' % (post_id, i + 1, ' '.join(cut_tags(tags)), ext)
+        if ugoira:
+            print('Post[%10s] Found animated art: %s' % (post_id, link))
+            return self._dl_ugoira(posts_dir, post_id, file)
+        return dl_url(self.session, link, posts_dir, file, int(post_id), headers={'Referer': self.POST_URL % post_id})
+
     def _download_post(self, posts_dir, post_id, post=None):
-        page = self._get_page(post_id)
-        if page is None: return True
-        if not post: post = self._get_meta(page, post_id).get('illust', {}).get(post_id)
+        if not post: post = self._get_post(post_id)
         if not post: return True
-        links, ext = self._gen_urls(post['urls']['original'], post['userIllusts'][post_id]['pageCount'])
+        links = self._get_links(post_id, post)
+        if not links: return False
         tags = self._get_tags(post)
-        self.HEADERS['Referer'] = self.POST_URL % post_id
-        result = True
-        for i, link in enumerate(links):
-            if link.find('ugoira') > 0:
-                print('Post[%10s] Found GIF art: %s' % (post_id, link))
-                resp = request('GET', self.UGOIRA_DL_URL,
-                               params={'url': self.HEADERS['Referer'], 'format': 'gif'})
-                if resp.status_code != 200:
-                    print('Post[%10s] Failed to convert post to GIF: %s' % (post_id, resp.text))
-                    return False
-                else:
-                    link, ext = resp.json()['url'], 'gif'
-            resp = request('GET', link, cookies=self.cookies, headers=self.HEADERS, proxies=PROXIES)
-            if resp.status_code == 200:
-                result &= dl_file(resp, posts_dir, '%s p%03d %s.%s' %
-                                  (post_id, i + 1, ' '.join(cut_tags(tags)), ext), int(post_id))
-        return result
-
-    def download_posts(self, post_id, load_all=False):
-        page = self._get_page(post_id)
-        if page is None: return
-        post = self._get_meta(page, post_id)['illust'][post_id]
-
-        posts_ = self.history.get_item('posts', post['userId'], [])
+        # pages of one work download side by side, a missing page (None) doesn't fail the post
+        with ThreadPoolExecutor(min(self.workers, len(links))) as executor:
+            results = list(executor.map(lambda p: self._download_page(posts_dir, post_id, tags, *p), enumerate(links)))
+        return all(result is not False for result in results)
+
+    def download_posts(self, post_id, load_all=False, full_sweep=False):
+        post = self._get_post(post_id)
+        if post is None: return
+
+        user_id = post['userId']
         posts_dir = make_tag_dir(self.work_dir, post['userName'] + ' ' + post['userAccount'])
 
+        # post ids are kept as strings, the same way pixiv keys them in its ajax replies
         if load_all:
-            for post_id_ in post['userIllusts'].keys():
-                if post_id_ in posts_: continue
-                if self._download_post(posts_dir, post_id_): posts_.append(post_id_)
-                self.history.save()
-                sleep(0.3)
+            mark = Watermark(self.history, 'pixiv:' + user_id, full_sweep)
+            post_ids = self._get_user_posts(user_id, post_id)
+            mark.reached(post_ids)  # all ids come in one go, this only records the newest
+            post_ids = [post_id_ for post_id_ in post_ids
+                        if not mark.below(post_id_) and not self.history.contains('posts', user_id, post_id_)]
+            with ThreadPoolExecutor(self.workers) as executor:
+                for i, (post_id_, post_) in enumerate(self._get_posts(executor, post_ids)):
+                    if self._download_post(posts_dir, post_id_, post_):
+                        self.history.add('posts', user_id, post_id_)
+                    else:
+                        mark.fail(post_id_)
+                    if i % self.SAVE_EVERY == self.SAVE_EVERY - 1: self.history.save()
+            mark.commit()
+            self.history.save()
         else:
-            if int(post_id) not in posts_:
-                if self._download_post(posts_dir, post_id, post): posts_.append(post_id)
+            if not self.history.contains('posts', user_id, post_id):
+                if self._download_post(posts_dir, post_id, post): self.history.add('posts', user_id, post_id)
             self.history.save()
 
 
@@ -116,6 +181,9 @@ def args_parse():
     parser = ArgumentParser(description='pixiv imageboard downloader')
     parser.add_argument('--work_dir', type=str, default=WORK_DIR)
     parser.add_argument('--dl_all', required=False, action='store_true')
+    parser.add_argument('--full_sweep', required=False, action='store_true')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--ugoira', type=str, default='gif', choices=list(UGOIRA_FORMATS.keys()))
     parser.add_argument('post_id', type=str)
     args = parser.parse_args()
     print(args)
@@ -124,9 +192,9 @@ def args_parse():
 
 def main():
     args = args_parse()
-    pixiv = Pixiv(args.work_dir)
+    pixiv = Pixiv(args.work_dir, workers=args.workers, ugoira_format=args.ugoira)
     for post_id in args.post_id.split(','):
-        pixiv.download_posts(post_id, args.dl_all)
+        pixiv.download_posts(post_id, args.dl_all, args.full_sweep)
 
 
 if __name__ == '__main__':
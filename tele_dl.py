@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
+from asyncio import ensure_future, gather
 from datetime import datetime as dt
 from datetime import timedelta as td
 from re import findall, match
 
-from requests import request
 from telethon import TelegramClient
 from telethon.tl.types import DocumentAttributeFilename
 
@@ -15,6 +15,7 @@ class TelethonDL:
 
     PICS_CHAT = 'P.S.T.N.A.'
     DANBOORU_CHANNEL = 'dnbooru'
+    SAVE_EVERY = 20
 
     def __init__(self, work_dir=WORK_DIR, history=None):
         self.work_dir = work_dir
@@ -24,7 +25,7 @@ class TelethonDL:
         del api_data['app_name']
         # https://docs.telethon.dev/en/latest/basic/quick-start.html
         self.client = TelegramClient(join(BASE_DIR, app_name), **api_data)
-        self.history = history if history else History(file_name=app_name + '.json')
+        self.history = history if history else make_history(file_name=app_name + '.json')
 
     async def _get_danbooru_links(self, cnt):
         links = []
@@ -44,53 +45,100 @@ class TelethonDL:
         self.history.save()
         return links
 
-    def _dl_danbooru_link(self, link):
+    async def _dl_danbooru_link(self, session, link):
         name, ext = link['url'].split('/')[-1].split('.')
-        resp = request('GET', link['url'], stream=True, proxies=PROXIES)
-        if resp.status_code == 200:
-            dl_file(resp, self.work_dir, '%s %s.%s' % (' '.join(link['tags']), name[:8], ext), 0)
+        await session.dl_url(link['url'], self.work_dir, '%s %s.%s' % (' '.join(link['tags']), name[:8], ext), 0)
+
+    async def _dl_danbooru_arts(self, cnt):
+        links = await self._get_danbooru_links(cnt)
+        async with AsyncSession() as session:
+            await gather(*[self._dl_danbooru_link(session, link) for link in links])
+
+    def connect(self):
+        # a long running process keeps the client connected, _run then skips connecting for every call
+        self.client.start()
+
+    def _run(self, coro):
+        if self.client.is_connected(): return self.client.loop.run_until_complete(coro)
+        with self.client: return self.client.loop.run_until_complete(coro)
 
     def download_danbooru_arts(self, cnt=50):
-        with self.client: links = self.client.loop.run_until_complete(self._get_danbooru_links(cnt))
-        for link in links: self._dl_danbooru_link(link)
+        self._run(self._dl_danbooru_arts(cnt))
+
+    TG_NAME = r'(\w+?)_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\.(\w{3,4})'
+
+    def _prev_second(self, file_name):
+        tg_name = findall(self.TG_NAME, file_name)[0]
+        return '%s_%s.%s' % (tg_name[0], (
+                dt.strptime(tg_name[1], self.DATE_FMT) - td(seconds=1)).strftime(self.DATE_FMT), tg_name[2])
 
     def _get_photo_path(self, date):
-        file_path = self.work_dir + 'photo_%s.jpg' % date.strftime(self.DATE_FMT)
-        return self._get_photo_path(date - td(seconds=1)) if isfile(file_path) else file_path
+        file_name = 'photo_%s.jpg' % date.strftime(self.DATE_FMT)
+        return self.work_dir + get_allocator(self.work_dir).allocate(file_name, self._prev_second)
 
     def _get_document_path(self, file_name):
-        file_path = self.work_dir + file_name
-        tg_name = findall(r'(\w+?)_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\.(\w{3,4})', file_name)
-        if not tg_name or not isfile(file_path): return file_path
-        return self._get_document_path('%s_%s.%s' % (tg_name[0][0], (
-                dt.strptime(tg_name[0][1], self.DATE_FMT) - td(seconds=1)).strftime(self.DATE_FMT), tg_name[0][2]))
+        next_name = self._prev_second if findall(self.TG_NAME, file_name) else None
+        return self.work_dir + get_allocator(self.work_dir).allocate(file_name, next_name)
+
+    def _get_media_paths(self, msg):
+        # names are taken before any download starts, so concurrent messages never share a file
+        paths = []
+        if msg.photo:
+            paths.append(('Photo', self._get_photo_path(msg.photo.date)))
+        if msg.document and isinstance(msg.document.attributes[1], DocumentAttributeFilename):
+            paths.append(('Document', self._get_document_path(msg.document.attributes[1].file_name)))
+        return paths
+
+    @staticmethod
+    async def _dl_message(msg, paths, slots):
+        async with slots:
+            for kind, path in paths:
+                p = await msg.download_media(file=path)
+                print('%s downloaded to %s' % (kind, p))
+            # await msg.mark_read()
+
+    def _drop_media(self, paths):
+        # files of a message that will be fetched again are removed and their names given back
+        for _, path in paths:
+            if exists(path): remove(path)
+            get_allocator(self.work_dir).release(path[len(self.work_dir):])
 
-    async def _dl_chat_arts(self, subj, cnt):
+    async def _dl_chat_arts(self, subj, cnt, workers=1):
         last_msg = self.history.get_item(subj, 'last_msg', {'id': 0})
-        async for msg in self.client.iter_messages(subj, limit=cnt, min_id=last_msg['id']):
-            if msg.photo:
-                p = await msg.download_media(file=(self._get_photo_path(msg.photo.date)))
-                print('Photo downloaded to ' + p)
-            if msg.document and isinstance(msg.document.attributes[1], DocumentAttributeFilename):
-                p = await msg.download_media(file=(self._get_document_path(msg.document.attributes[1].file_name)))
-                print('Document downloaded to ' + p)
-            # await msg.mark_read()
-            if last_msg['id'] < msg.id:
-                last_msg['id'] = msg.id
-                self.history.save()
+        slots, tasks = AsyncSemaphore(workers), []
+        # oldest first, so last_msg only moves past a contiguous run of finished messages
+        async for msg in self.client.iter_messages(subj, limit=cnt, min_id=last_msg['id'], reverse=True):
+            paths = self._get_media_paths(msg)
+            tasks.append((msg.id, paths, ensure_future(self._dl_message(msg, paths, slots))))
+        for i, (msg_id, paths, task) in enumerate(tasks):
+            try:
+                await task
+            except Exception as e:
+                print('Message %d failed, stopping at %d: %s' % (msg_id, last_msg['id'], e))
+                # later messages are downloaded again on the next run, so they are stopped and undone now
+                rest = tasks[i:]
+                for _, _, task_ in rest: task_.cancel()
+                await gather(*[task_ for _, _, task_ in rest], return_exceptions=True)
+                for _, paths_, _ in rest: self._drop_media(paths_)
+                break
+            last_msg['id'] = msg_id
+            if i % self.SAVE_EVERY == self.SAVE_EVERY - 1: self.history.save()
+        self.history.save()
 
-    def download_chat_arts(self, subj, cnt=50):
-        with self.client: self.client.loop.run_until_complete(self._dl_chat_arts(subj, cnt))
+    def download_chat_arts(self, subj, cnt=50, workers=1):
+        self._run(self._dl_chat_arts(subj, cnt, workers))
 
     async def send_file(self, subj, path_to_file):
         await self.client.send_file(subj, path_to_file, caption='It works!')
 
     def test_send_file(self, subj, path_to_file):
-        with self.client: self.client.loop.run_until_complete(self.send_file(subj, path_to_file))
+        self._run(self.send_file(subj, path_to_file))
 
 def main():
+    file_index = use_file_index(FileIndex())
     teleton = TelethonDL('D:\\_downloads_\\!images!\\')
     teleton.download_danbooru_arts(125)
+    file_index.report()
     # teleton.download_chat_arts(teleton.PICS_CHAT, 100)
     # teleton.test_send_file('Вака ДХС', 'D:\\_downloads_\\VodkaSubs_Selection_Project_02_1080p_AVC_AAC_track3_rus.ass')
 
@@ -1,38 +1,48 @@
 # -*- coding: utf-8 -*-
 from argparse import ArgumentParser
-from functools import reduce
-from os import listdir
-from os.path import split
-from re import findall, sub
-from subprocess import getstatusoutput
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir, makedirs
+from os.path import split, basename
+from re import findall
+from sys import intern
 from urllib import parse
-
-from bs4 import BeautifulSoup as bs
-from requests import request
+from zipfile import ZipFile, BadZipFile
 
 from commons import *
 
 
 class Yanderer:
-    SLEEP_TIME = 0.1
+    RATE = 10.0
+    PAGE_ONLY = None
+    CACHE_PAGES = False
 
-    def __init__(self, work_dir=WORK_DIR, history=None):
+    def __init__(self, work_dir=WORK_DIR, history=None, workers=1):
         self.work_dir = work_dir
-        self.history = history if history else History(file_name='yandere.json')
+        self.history = history if history else make_history(file_name='yandere.json')
         self.limit_pages = None
+        self.complete = True
+        self.workers = workers
         with open(join(BASE_DIR, 'cookies', 'yandere_.json'), 'r') as f:
             self.cookies = load(f)
-
-    def _get_page(self, page_url, params=None):
-        resp = request('GET', page_url, params=params, cookies=self.cookies, proxies=PROXIES)
-        return bs(resp.text, features='html.parser')
-
-    def _get_last_page(self, page):
+        self.session = get_session('yande.re', cookies=self.cookies, rate=self.RATE)
+        self.cache = get_response_cache() if self.CACHE_PAGES else None
+
+    def _parse_page(self, text, page_num):
+        page = parse_html(text, self.PAGE_ONLY)
+        return {'last_page': self._get_last_page(page), 'items': self._parse_items(page, page_num)}
+
+    def _get_page(self, page_url, page_num, params=None):
+        # a cached page that wasn't modified comes back already parsed, None is a page that failed
+        parse = lambda text: self._parse_page(text, page_num)
+        if self.cache: return self.cache.get(self.session, page_url, parse, params)
+        resp = self.session.get(page_url, params=params)
+        if resp.status_code == 200: return parse(resp.text)
+        print('Item[%10d] Failed to get page %d: %d' % (0, page_num, resp.status_code))
+
+    @staticmethod
+    def _get_last_page(page):
         pager = page.find('div', class_='pagination')
-        if not pager: return 1
-        last_page = int(pager.find_all('a')[-2].text)
-        return self.limit_pages if self.limit_pages and self.limit_pages < last_page else last_page
+        return int(pager.find_all('a')[-2].text) if pager else 1
 
     def _get_items(self, page):
         return []
@@ -40,24 +50,74 @@ class Yanderer:
     def _process_item(self, item):
         return {0: {}}
 
-    def _collect_items(self, paged_url, params=None):
+    def _parse_items(self, page, page_num):
+        result = {}
+        items = self._get_items(page)
+        for item in items: result.update(self._process_item(item))
+        print('Item[%10d] Found %d items on page %d' % (0, len(items), page_num))
+        return result
+
+    def _load_items(self, paged_url, params, page_num):
+        page = self._get_page(paged_url % page_num, page_num, params)
+        if page is None:
+            self.complete = False
+            return {}
+        return page['items']
+
+    def _collect_items(self, paged_url, params=None, stop=None):
+        # stop(items) ends the crawl early, pages are then walked one by one,
+        # complete tells afterwards whether every page came through
         print('Item[%10d] Grabbing items' % 0)
-        page = self._get_page(paged_url % 1, params)
-        last_page = self._get_last_page(page)
+        self.complete = True
+        page = self._get_page(paged_url % 1, 1, params)
+        if page is None:
+            self.complete = False
+            return {}
+        last_page = page['last_page']
+        if self.limit_pages and self.limit_pages < last_page: last_page = self.limit_pages
         print('Item[%10d] Found %d page(s)' % (0, last_page))
-        result = {}
-        for i in range(2, last_page + 2):
-            items = self._get_items(page)
-            for item in items: result.update(self._process_item(item))
-            print('Item[%10d] Found %d items on page %d' % (0, len(items), i - 1))
-            sleep(self.SLEEP_TIME)
-            if i <= last_page: page = self._get_page(paged_url % i, params)
+        result = page['items']
+        pages = range(2, last_page + 1)
+        if stop:
+            if not stop(result):
+                for i in pages:
+                    items = self._load_items(paged_url, params, i)
+                    result.update(items)
+                    if not self.complete or stop(items): break
+        elif self.workers > 1:
+            # pages are fetched and parsed out of order, executor.map hands them back in page order
+            with ThreadPoolExecutor(self.workers) as executor:
+                for items in executor.map(lambda i: self._load_items(paged_url, params, i), pages):
+                    result.update(items)
+        else:
+            for i in pages: result.update(self._load_items(paged_url, params, i))
         print('Item[%10d] Total items found: %d' % (0, len(result)))
         return result
 
 
+class TagIndex:
+    NESTED_RE = r'\(([^()]*)\)'
+
+    def __init__(self, categories):
+        # tag -> position of the first category it belongs to, names are interned to share storage
+        self.ranks = {}
+        for rank, tags in enumerate(categories):
+            for tag in tags: self.ranks.setdefault(intern(tag), rank)
+
+    def filter(self, tags):
+        ranks = self.ranks
+        found = [(ranks[tag], tag) for tag in set(tags.split(' ')) if tag in ranks]
+        if '(' in tags:
+            nested = set(findall(self.NESTED_RE, tags))
+            # tags with their own brackets can't be matched through the nested set
+            found = [(rank, tag) for rank, tag in found if tag not in nested and not (
+                ('(' in tag or ')' in tag) and tags.find('(%s)' % tag) != -1)]
+        found.sort()
+        return [tag for _, tag in found]
+
+
 class Tagger(Yanderer):
-    # TAGS_JSON = 'https://yande.re/tag.json?limit=0' #TODO
+    TAGS_JSON = 'https://yande.re/tag.json?limit=0'
     TAGS_URL = 'https://yande.re/tag?limit=500&page=%d&type='
     TAGS = {
         'artist': {'id': '1', 'class': 'tag-type-artist', 'tags': set()},
@@ -67,12 +127,17 @@ class Tagger(Yanderer):
         'faults': {'id': '6', 'class': 'tag-type-faults', 'tags': set()},
         'general': {'id': '0', 'class': 'tag-type-general', 'tags': set()}
     }
+    PAGE_ONLY = html_only(['td', 'div'], [t['class'] for t in TAGS.values()] + ['pagination'])
+    CACHE_PAGES = True
 
-    def __init__(self, work_dir=WORK_DIR, history=None):
-        super().__init__(work_dir, history)
+    def __init__(self, work_dir=WORK_DIR, history=None, workers=1):
+        super().__init__(work_dir, history, workers)
         self.tag_type = self.TAGS['artist']
         for tag in self.TAGS.keys():
-            self.TAGS[tag]['tags'] = set(self.history.get_item('tags', tag, []))
+            tags = self.history.get_item('tags', tag, [])
+            # stored as one space joined string, older histories have a list
+            self.TAGS[tag]['tags'] = set(tags.split() if isinstance(tags, str) else tags)
+        self.index = TagIndex(tags_['tags'] for tags_ in self.TAGS.values())
 
     def _get_items(self, page):
         return page.find_all('td', class_=self.tag_type['class'])
@@ -88,34 +153,73 @@ class Tagger(Yanderer):
         print('Tags[%10d] Total tags found: %d' % (0, len(tags)))
         return list(tags.keys())
 
-    def update_tags(self, update_all=False):
+    def _save_tags(self, tag, tag_type):
+        self.history.set_item('tags', tag, ' '.join(sorted(tag_type['tags'])))
+        self.history.save()
+
+    def _sync_catalog(self):
+        # the whole catalog in one streamed request, sorted into every category in a single pass
+        print('Tags[%10d] Loading tag catalog' % 0)
+        types = {int(tag_type['id']): set() for tag_type in self.TAGS.values()}
+        with self.session.get(self.TAGS_JSON, stream=True) as resp:
+            if resp.status_code != 200:
+                print('Tags[%10d] Failed to load tag catalog: %d' % (0, resp.status_code))
+                return False
+            resp.encoding = resp.encoding or 'utf-8'
+            for item in iter_json_array(resp.iter_content(CHUNK_SIZE, decode_unicode=True)):
+                if item['type'] in types: types[item['type']].add(intern(item['name']))
         for tag, tag_type in self.TAGS.items():
-            print('Tags[%10d] Processing tags: %s' % (0, int(tag_type['id'])))
-            self.tag_type = tag_type
-            tags = self._get_tags(5 if not update_all else None)
-            if not update_all:
-                tag_type['tags'] = set(tags).union(tag_type['tags'])
-            else:
-                tag_type['tags'] = set(tags)
-            self.history.set_item('tags', tag, list(sorted(tag_type['tags'])))
-            self.history.save()
+            tag_type['tags'] = types[int(tag_type['id'])]
+            print('Tags[%10d] Total tags found: %d' % (int(tag_type['id']), len(tag_type['tags'])))
+            self._save_tags(tag, tag_type)
+        return True
+
+    def update_tags(self, update_all=False):
+        if not update_all or not self._sync_catalog():
+            for tag, tag_type in self.TAGS.items():
+                print('Tags[%10d] Processing tags: %s' % (0, int(tag_type['id'])))
+                self.tag_type = tag_type
+                tags = self._get_tags(5 if not update_all else None)
+                if not update_all:
+                    tag_type['tags'] = set(tags).union(tag_type['tags'])
+                else:
+                    tag_type['tags'] = set(tags)
+                self._save_tags(tag, tag_type)
+        self.index = TagIndex(tags_['tags'] for tags_ in self.TAGS.values())
 
     def filter_tags(self, tags):
-        origin = set(tags.split(' '))
-        filtered = reduce(lambda x, y: x + y, [list(sorted(filter(
-            lambda c: tags.find('(%s)' % c) == -1, origin.intersection(tags_['tags'])
-        ))) for tags_ in self.TAGS.values()])
+        filtered = self.index.filter(tags)
         if len(filtered) == 0: filtered = tags.split(' ')
         return ' '.join(cut_tags(filtered))
 
+    def filter_tags_many(self, tags_list):
+        cache = {}
+        for tags in tags_list:
+            if tags not in cache: cache[tags] = self.filter_tags(tags)
+        return [cache[tags] for tags in tags_list]
+
+
+_taggers = {}
+
+
+def get_tagger(history=None, workers=1):
+    # Poster and Pooler working on one history with the same workers share a tagger and its index
+    history = history if history else make_history(file_name='yandere.json')
+    key = (history, workers)
+    if key not in _taggers: _taggers[key] = Tagger(history=history, workers=workers)
+    return _taggers[key]
+
 
 class Pooler(Yanderer):
     POOL_URL = 'https://yande.re/pool/%s/%s'
     POOL_PAGE = 'https://yande.re/pool?limit=200&page=%d'
+    PAGE_ONLY = html_only(['table', 'div'], ['highlightable', 'pagination'])
+    CACHE_PAGES = True
+    THUMBS_ONLY = html_only('a', ['thumb', 'next_page'])
 
-    def __init__(self, work_dir=WORK_DIR, history=None, tagger=None):
-        super().__init__(work_dir, history)
-        self.tagger = tagger if tagger else Tagger()
+    def __init__(self, work_dir=WORK_DIR, history=None, tagger=None, workers=1):
+        super().__init__(work_dir, history, workers)
+        self.tagger = tagger if tagger else get_tagger(self.history, workers)
         self.pool_name = ''
         self.pool_id = 0
 
@@ -131,10 +235,9 @@ class Pooler(Yanderer):
         }}
 
     def _get_image_tags_page(self, page=1):
-        resp = request('GET', (self.POOL_URL + '?page=%d' % page) % ('show', self.pool_id),
-                       cookies=self.cookies, proxies=PROXIES)
+        resp = self.session.get((self.POOL_URL + '?page=%d' % page) % ('show', self.pool_id))
         if resp.status_code != 200: return [], True
-        page = bs(resp.text, features='html.parser')
+        page = parse_html(resp.text, self.THUMBS_ONLY)
         links = page.find_all('a', class_='thumb')
         result = []
         for link in links:
@@ -155,62 +258,61 @@ class Pooler(Yanderer):
 
     def _dl_archive(self):
         print('Pool[%10d] Downloading archive: %s' % (self.pool_id, self.pool_name))
-        resp = request('GET', self.POOL_URL % ('zip', self.pool_id),params={'png': 1},
-                       cookies=self.cookies, stream=True, proxies=PROXIES)
-        if resp.status_code == 200:
-            print('Pool[%10d] Found PNG archive' % self.pool_id)
-        else:
-            resp = request('GET', self.POOL_URL % ('zip', self.pool_id), params={'jpeg': 1},
-                           cookies=self.cookies, stream=True, proxies=PROXIES)
-            if resp.status_code == 200:
-                print('Pool[%10d] Found JPG archive' % self.pool_id)
-            else:
-                print('Pool[%10d] archive not found' % self.pool_id)
-                return False
-        return dl_file(resp, self.work_dir, '%d.zip' % self.pool_id, self.pool_id)
-
-    def _unzip_archive(self):
-        file_name = '%d.zip' % self.pool_id
-        file_path = join(self.work_dir, file_name)
-        dir_path = join(self.work_dir, str(self.pool_id))
-        code, error = getstatusoutput(
-            '"%s" x -o"%s" "%s"' % ('C:\\Program Files\\7-Zip\\7z', dir_path, file_path))
-        if code != 0:
-            print('Pool[%10d] Failed to unzip archive "%s": %s' % (self.pool_id, file_name, error))
-            return False
-        print('Pool[%10d] Archive uzipped: "%s"' % (self.pool_id, dir_path))
+        # each variant resumes its own .part, a partial PNG archive is never continued with JPEG bytes
+        for params, kind in (({'png': 1}, 'PNG'), ({'jpeg': 1}, 'JPG')):
+            file_name = '%d %s.zip' % (self.pool_id, kind)
+            # a stale archive would push the new one to a numbered name
+            if isfile(join(self.work_dir, file_name)): self._remove_archive(join(self.work_dir, file_name))
+            result = dl_url(self.session, self.POOL_URL % ('zip', self.pool_id), self.work_dir,
+                            file_name, self.pool_id, params=params)
+            if result is not None:
+                print('Pool[%10d] Found %s archive' % (self.pool_id, kind))
+                return result or None
+        print('Pool[%10d] archive not found' % self.pool_id)
+        return None
+
+    @staticmethod
+    def _order_files(files):
+        # numbered names sort as if padded to "name (0001).ext", the order 7-Zip output used to be renamed in
+        # members are ordered by their own names, folders inside the archive only keep equal names apart
+        parsed = {f: findall(r'([-~^&\w]*?)(?: \((\d{1,4})\))?\.(\w{3,4})', basename(f))[0] for f in files}
+        numbered = {name for name, num, _ in parsed.values() if num}
+        return sorted(files, key=lambda f: ('%s (%04d).%s' % (parsed[f][0], int(parsed[f][1] or 1), parsed[f][2])
+                                            if parsed[f][0] in numbered else basename(f), f))
+
+    def _extract_archive(self, file_path, tags):
+        # the archive is removed whether it unpacks or not, the next run downloads it again
+        try:
+            return self._unpack_archive(file_path, tags)
+        finally:
+            self._remove_archive(file_path)
+            print('Pool[%10d] Archive removed: "%s"' % (self.pool_id, file_path))
+
+    @staticmethod
+    def _remove_archive(file_path):
         remove(file_path)
-        print('Pool[%10d] Archive removed: "%s"' % (self.pool_id, file_path))
-        return True
-
-    def _fix_file_names(self):
-        dir_path = join(self.work_dir, str(self.pool_id))
-        files = listdir(dir_path)
-        broken = list(map(lambda f: (f[0], (f[0][0], '%04d' % int(f[0][1]), f[0][2])), filter(
-            lambda f: len(f) > 0 and len(f[0][1]) > 0, map(
-                lambda f: findall(r'([-~^&\w]*?)(?: \((\d{1,3})\))?\.(\w{3,4})', f), files))))
-        for file, file_ in broken:
-            rename(join(dir_path, '%s (%s).%s' % file), join(dir_path, '%s (%s).%s' % file_))
-        broken_ = set(map(lambda f: f[0][0], broken))
-        broken_ = list(map(lambda f: (f, sub(r'([-~^&\w]*?)\.(\w{3,4})', r'\1 (0001).\2', f)),
-                           filter(lambda f: f.split('.')[0] in broken_, files)))
-        for file, file_ in broken_:
-            rename(join(dir_path, file), join(dir_path, file_))
-        if broken: print('Pool[%10d] Fixed %d broken file names' % (self.pool_id, len(broken) + len(broken_)))
-
-    def _rename_images(self, tags):
-        posts = []
-        dir_path = join(self.work_dir, str(self.pool_id))
-        files = listdir(dir_path)
-        for i, file in enumerate(files):
-            name, ext = findall(r'([-~^&\w]*?)(?: \(\d{4}\))?\.(\w{3,4})', file)[0]
-            file_ = '%s %s.%s' % (name, tags[i], ext)
-            rename(join(dir_path, file), join(dir_path, file_))
-            posts.append(file_)
-        posts = self._print_info(dir_path, posts)
-        rename(dir_path, join(self.work_dir, self.pool_name))
-        print('Pool[%10d] Folder and images renamed' % self.pool_id)
-        return posts
+        release_path(file_path)
+
+    def _unpack_archive(self, file_path, tags):
+        dir_path = join(self.work_dir, self.pool_name)
+        names = []
+        try:
+            with ZipFile(file_path) as zf:
+                members = {m.filename: m for m in zf.infolist() if not m.is_dir()}
+                files = self._order_files(list(members.keys()))
+                if len(tags) < len(files):
+                    print('Pool[%10d] Got %d tags for %d images' % (self.pool_id, len(tags), len(files)))
+                    return []
+                makedirs(dir_path, exist_ok=True)
+                for file, tags_ in zip(files, tags):
+                    name, ext = findall(r'([-~^&\w]*?)(?: \(\d{1,4}\))?\.(\w{3,4})', basename(file))[0]
+                    file_ = '%s %s.%s' % (name, tags_, ext)
+                    with zf.open(members[file]) as src: names.append(basename(store_file(src, join(dir_path, file_))))
+        except BadZipFile as e:
+            print('Pool[%10d] Failed to unzip archive "%s": %s' % (self.pool_id, basename(file_path), e))
+            return []
+        print('Pool[%10d] Archive unzipped: "%s"' % (self.pool_id, dir_path))
+        return self._print_info(dir_path, names)
 
     def _print_info(self, dir_path, names):
         posts = []
@@ -227,12 +329,13 @@ class Pooler(Yanderer):
     def _process_pool(self, pool_id, pool_name):
         self.pool_id = int(pool_id)
         self.pool_name = pool_name
-        if not self._dl_archive(): return []
+        file_path = self._dl_archive()
+        if not file_path: return []
         tags = self._get_image_tags()
-        if not tags: return []
-        if not self._unzip_archive(): return []
-        self._fix_file_names()
-        return self._rename_images(tags)
+        if not tags:
+            self._remove_archive(file_path)
+            return []
+        return self._extract_archive(file_path, tags)
 
     def _merge_history(self, pools):
         pools_ = self.history.get_category('pools')
@@ -271,15 +374,21 @@ class Pooler(Yanderer):
 
 class Poster(Yanderer):
     POST_URL = 'https://yande.re/post?limit=200&page=%d'
+    PAGE_ONLY = html_only(['a', 'div'], ['directlink', 'pagination'])
+    SAVE_EVERY = 50
 
-    def __init__(self, work_dir=WORK_DIR, history=None, tagger=None):
-        super().__init__(work_dir, history)
-        self.tagger = tagger if tagger else Tagger()
+    def __init__(self, work_dir=WORK_DIR, history=None, tagger=None, workers=1):
+        super().__init__(work_dir, history, workers)
+        self.tagger = tagger if tagger else get_tagger(self.history, workers)
         self.post_dir = work_dir
-        self.pooled_posts = []
+        self.pooled_posts = set()
+
+    def _get_pooled_posts(self):
+        # pools downloaded since the last job add their posts, so this is gathered again for every job
+        pooled_posts = set()
         for pool_id, pool in self.history.get_category('pools').items():
-            self.pooled_posts += pool.get('pool_posts', [])
-        self.pooled_posts = set(self.pooled_posts)
+            pooled_posts.update(pool.get('pool_posts', []))
+        return pooled_posts
 
     def _get_items(self, page):
         return page.find_all('a', class_='directlink largeimg')
@@ -303,44 +412,64 @@ class Poster(Yanderer):
         return {int(post_id): post}
 
     def _download_post(self, post_id, post):
-        if post.get('png'):
-            resp = request('GET', post['png']['url'], cookies=self.cookies, proxies=PROXIES)
-            if resp.status_code == 200:
-                print('Post[%10d] Found PNG post' % post_id)
-                return dl_file(resp, self.post_dir, post['png']['file'], post_id)
+        post_ = post.get('png', post['raw'])
+        with host_slot(post_['url']):
+            result = dl_url(self.session, post_['url'], self.post_dir, post_['file'], post_id)
+        if result and post.get('png'): print('Post[%10d] Found PNG post' % post_id)
+        return result
+
+    def _download_all(self, posts):
+        if self.workers > 1:
+            with ThreadPoolExecutor(self.workers) as executor:
+                yield from zip(posts.keys(), executor.map(lambda p: self._download_post(*p), posts.items()))
         else:
-            resp = request('GET', post['raw']['url'], cookies=self.cookies, proxies=PROXIES)
-            if resp.status_code == 200:
-                return dl_file(resp, self.post_dir, post['raw']['file'], post_id)
+            for post_id, post in posts.items():
+                yield post_id, self._download_post(post_id, post)
 
-    def download_posts(self, tag):
+    def download_posts(self, tag, full_sweep=False):
         self.post_dir = make_tag_dir(self.work_dir, tag)
-
-        posts_ = self.history.get_item('posts', tag, [])
+        self.pooled_posts = self._get_pooled_posts()
+        mark = Watermark(self.history, 'yande.re:' + tag, full_sweep)
 
         print('Post[%10d] Grabbing posts' % 0)
-        posts = self._collect_items(self.POST_URL, {'tags': tag})
+        # a full sweep has no stop, its pages are then fetched concurrently
+        posts = self._collect_items(self.POST_URL, {'tags': tag}, None if mark.full else mark.reached)
+        complete = self.complete
+        mark.reached(posts.keys())
+        if mark.retry and not mark.full:
+            posts.update(self._collect_items(self.POST_URL, {'tags': 'id:' + ','.join(map(str, sorted(mark.retry)))}))
+            # retries that couldn't be listed stay for the next run
+            if not self.complete:
+                for post_id in mark.retry.difference(posts.keys()): mark.fail(post_id)
         print('Post[%10d] Total posts found: %d' % (0, len(posts)))
 
-        for post_id, post in posts.items():
-            if post_id in posts_ or post_id in self.pooled_posts: continue
-            if self._download_post(post_id, post): posts_.append(post_id)
-            sleep(self.SLEEP_TIME)
+        posts = {post_id: post for post_id, post in posts.items() if not mark.below(post_id)
+                 and not self.history.contains('posts', tag, post_id) and post_id not in self.pooled_posts}
+        # results come back in crawl order, so history is only ever touched from this thread
+        for i, (post_id, result) in enumerate(self._download_all(posts)):
+            if result:
+                self.history.add('posts', tag, post_id)
+            else:
+                mark.fail(post_id)
+            if i % self.SAVE_EVERY == self.SAVE_EVERY - 1: self.history.save()
 
-        self.history.set_item('posts', tag, list(sorted(posts_, reverse=True)))
+        self.history.sort_ids('posts', tag, reverse=True)
+        mark.commit(complete)
         self.history.save()
 
 
 def rename_posts(work_dir=WORK_DIR, file_list='yandere.rename.txt'):
-    tagger = Tagger()
+    tagger = get_tagger()
     with open(join(work_dir, file_list), 'r', encoding='utf-8') as f:
         files = [line[:-1] for line in f.readlines()[1:]]
+    found = []
     for file in files:
         path = split(file)
-        found = findall(r'^yande\.re (\d+) (.+?)\.(\w{3,4})$', path[1])
-        if not found: continue
-        post_id, tags, ext = found[0]
-        rename(join(path[0], file), join(path[0], '%s %s.%s' % (post_id, tagger.filter_tags(tags), ext)))
+        found_ = findall(r'^yande\.re (\d+) (.+?)\.(\w{3,4})$', path[1])
+        if found_: found.append((file, path[0]) + found_[0])
+    filtered = tagger.filter_tags_many([tags for _, _, _, tags, _ in found])
+    for (file, dir_path, post_id, _, ext), tags in zip(found, filtered):
+        rename(join(dir_path, file), join(dir_path, '%s %s.%s' % (post_id, tags, ext)))
 
 
 def rename_pools(work_dir):
@@ -359,6 +488,9 @@ def args_parse():
     parser.add_argument('--rename_pools', required=False, action='store_true')
     parser.add_argument('--rename_posts', required=False, action='store_true')
     parser.add_argument('--work_dir', type=str, default=WORK_DIR)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--dedup', required=False, action='store_true')
+    parser.add_argument('--full_sweep', required=False, action='store_true')
     parser.add_argument('--rename_file', type=str)
     parser.add_argument('--pool_id', type=str)
     parser.add_argument('--tags', type=str)
@@ -370,17 +502,18 @@ def args_parse():
 
 def main():
     args = args_parse()
+    file_index = use_file_index(FileIndex()) if args.dedup else None
 
     if args.update_tags:
-        tagger = Tagger()
+        tagger = get_tagger(workers=args.workers)
         tagger.update_tags(args.update_all)
 
     if args.update_pools:
-        pooler = Pooler(args.work_dir)
+        pooler = Pooler(args.work_dir, workers=args.workers)
         pooler.load_info(args.update_all)
 
     if args.pool_id:
-        pooler = Pooler(args.work_dir)
+        pooler = Pooler(args.work_dir, workers=args.workers)
         if args.pool_id == 'ALL':
             pooler.download_pools()
         else:
@@ -390,17 +523,20 @@ def main():
         rename_pools(args.work_dir)
 
     if args.tags:
-        poster = Poster(args.work_dir)
+        poster = Poster(args.work_dir, workers=args.workers)
         for tag in args.tags.split(','):
-            poster.download_posts(tag)
+            poster.download_posts(tag, args.full_sweep)
 
     if args.tag:
-        poster = Poster(args.work_dir)
-        poster.download_posts(args.tag)
+        poster = Poster(args.work_dir, workers=args.workers)
+        poster.download_posts(args.tag, args.full_sweep)
 
     if args.rename_posts:
         rename_posts(args.work_dir, args.rename_file)
 
+    if file_index: file_index.report()
+    if args.update_tags or args.update_pools: get_response_cache().report()
+
 
 if __name__ == '__main__':
     main()